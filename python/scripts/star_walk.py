@@ -1,22 +1,275 @@
-import socket
+#!/usr/bin/env python
+"""Load generator and latency benchmark of the Stellarium server.
+
+Many clients connect to a StellariumServer and send goto packets to the
+stars of a catalog at a given rate. The server drives a Pointer connected to
+the firmware emulator (or a mock one), and every goto is followed until the
+first position packet received by its client matches the target. The
+latencies of every stage are reported:
+
+    server:   goto packet sent -> goto callback called by the server
+    serial:   goto callback -> G command acknowledged by the board
+    position: G command -> first matching position packet
+    total:    goto packet sent -> first matching position packet
+
+Gotos replaced by a newer one (of any client) before being commanded or
+reached are counted as superseded.
+"""
+
+import os
 import time
-from pandas import read_csv
-from sky_pointer.server import encode_goto_packet
+import socket
+import logging
+import argparse
+import threading
+import numpy as np
+from sky_pointer.coords import EqCoords
+from sky_pointer.eventloop import EventLoop
+from sky_pointer.server import StellariumServerThread, StellariumFramer, \
+    encode_goto_packet, decode_goto_packet, decode_pos_packet
 
-HOST = 'localhost'
+HOST = '127.0.0.1'
 PORT = 10000
+CATALOG = os.path.join(os.path.dirname(__file__), 'ursa_maior.txt')
+FEED_PERIOD = .02   # Time (s) between position updates of the server
+TOLERANCE = 2e-3    # Max. distance (rad) of a position matching a target
+JITTER = 1e-8       # Offset (rad) making every goto target unique
+
+
+def read_catalog(path):
+    """Read the (ra, dec) columns of a star_walk catalog (lines with time,
+    ra, dec, and other columns, separated by spaces)"""
+    stars = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 3:
+                stars.append((float(fields[1]), float(fields[2])))
+    return stars
+
+
+class MockPointer(object):
+    """A Pointer that reaches every target after a fixed delay"""
+
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.__pos = EqCoords(0, 0)
+        self.__target = EqCoords(0, 0)
+        self.__t = 0
+
+    def goto(self, eq):
+        self.__pos = self.get_coords()
+        self.__target, self.__t = eq, time.time()
+
+    def get_coords(self):
+        if time.time() - self.__t >= self.delay:
+            return self.__target
+        return self.__pos
+
+    def close(self):
+        pass
+
+
+class EmulatedPointer(object):
+    """A Pointer connected to a firmware emulator, aligned so that the
+    instrumental coordinates are the equatorial ones"""
+
+    def __init__(self, speed=None, latency=0., binary=False):
+        from sky_pointer.emulator import Emulator, SPEED
+        from sky_pointer.pointer import Pointer
+        self.emu = Emulator(speed or SPEED, latency, binary=binary)
+        self.emu.start()
+        self.ptr = Pointer(self.emu.port, binary=binary)
+        t = time.time()
+        self.ptr.set_ref(EqCoords(0, 0), EqCoords(0, 0), t)
+        self.ptr.set_ref(EqCoords(1, 1), EqCoords(1, 1), t)
+
+    def goto(self, eq):
+        self.ptr.goto(eq)
+
+    def get_coords(self):
+        return self.ptr.get_coords()
+
+    def close(self):
+        self.ptr.close()
+        self.emu.close()
+
+
+class Goto(object):
+    __slots__ = ('target', 'sent', 'received', 'commanded', 'reached',
+                 'superseded')
+
+    def __init__(self, target, sent):
+        self.target = target
+        self.sent = sent
+        self.received = None
+        self.commanded = None
+        self.reached = None
+        self.superseded = False
+
+
+class Benchmark(object):
+    """Runs the server, the pointer and the clients.
+
+    pointer: MockPointer or EmulatedPointer
+    clients: number of client connections
+    rate: gotos per second sent by every client
+    pos_rate: position broadcasts per second of the server
+    """
+
+    def __init__(self, pointer, stars, clients=10, rate=.5, pos_rate=20.,
+                 host=HOST, port=PORT):
+        self.pointer = pointer
+        self.stars = stars
+        self.nclients = clients
+        self.rate = rate
+        self.gotos = {}     # target -> Goto
+        self.current = None     # last commanded Goto
+        self.lock = threading.Lock()
+        self.server = StellariumServerThread(host, port, goto=self.__goto,
+                                             rate=pos_rate, threshold=0)
+        self.address = (host, port)
+        self.loop = EventLoop()
+        self.pos_packets = 0
+        self.__seq = 0
+        self.__running = False
+
+    def __goto(self, eq):
+        # called by the server thread
+        received = time.time()
+        with self.lock:
+            goto = self.gotos.get((eq.x, eq.y))
+            if self.current and self.current.reached is None:
+                self.current.superseded = True
+            self.current = goto
+            goto.received = received
+        self.pointer.goto(eq)
+        goto.commanded = time.time()
+
+    def __feed(self):
+        while self.__running:
+            self.server.set_pos(self.pointer.get_coords())
+            time.sleep(FEED_PERIOD)
+
+    def __send(self, client):
+        sock, framer, pending = client
+        ra, dec = self.stars[self.__seq % len(self.stars)]
+        packet = encode_goto_packet((ra, dec + self.__seq*JITTER))
+        self.__seq += 1
+
+        # use the target decoded by the server, as a key of the goto
+        tgt = decode_goto_packet(packet)
+        goto = Goto(tgt, time.time())
+        with self.lock:
+            self.gotos[(tgt.x, tgt.y)] = goto
+        pending[:] = [goto]
+        sock.sendall(packet)
+        self.loop.call_later(1./self.rate, self.__send, client)
+
+    def __receive(self, client):
+        sock, framer, pending = client
+        data = sock.recv(4096)
+        now = time.time()
+        for packet in framer.feed(data):
+            self.pos_packets += 1
+            goto = pending[0] if pending else None
+            if goto and goto.received and not goto.superseded and \
+                    goto.target.isclose(decode_pos_packet(packet), TOLERANCE):
+                pending.pop().reached = now
+
+    def run(self, duration):
+        self.server.start()
+        self.__running = True
+        feeder = threading.Thread(target=self.__feed)
+        feeder.daemon = True
+        feeder.start()
+
+        for i in range(self.nclients):
+            sock = socket.create_connection(self.address)
+            client = (sock, StellariumFramer(), [])
+            self.loop.add_reader(sock.fileno(), self.__receive, client)
+            # spread the gotos of the clients along the period
+            self.loop.call_later((i + 1.)/self.nclients/self.rate,
+                                 self.__send, client)
+
+        end = self.loop.time() + duration
+        self.loop.call_at(end, self.loop.stop)
+        t0 = time.time()
+        self.loop.run_forever()
+        self.elapsed = time.time() - t0
+
+        self.__running = False
+        self.server.stop()
+        self.server.join()
+        self.pointer.close()
+
+    def report(self):
+        gotos = self.gotos.values()
+        done = [g for g in gotos if g.reached and g.commanded]
+        commanded = [g for g in gotos if g.commanded]
+        superseded = [g for g in gotos if g.superseded or not g.received]
+        print "Clients: %d, duration: %.1f s" % (self.nclients, self.elapsed)
+        print "Gotos sent: %d (%.1f/s), commanded: %d (%.1f/s), " \
+            "reached: %d, superseded: %d" % (
+                len(gotos), len(gotos)/self.elapsed, len(commanded),
+                len(commanded)/self.elapsed, len(done), len(superseded))
+        print "Position packets received: %d (%.1f/s)" % (
+            self.pos_packets, self.pos_packets/self.elapsed)
+        if not done:
+            return
+
+        print "%-10s %9s %9s %9s %9s  (ms)" % ('stage', 'p50', 'p90', 'p99',
+                                               'max')
+        stages = [('server', lambda g: g.received - g.sent),
+                  ('serial', lambda g: g.commanded - g.received),
+                  ('position', lambda g: g.reached - g.commanded),
+                  ('total', lambda g: g.reached - g.sent)]
+        for name, func in stages:
+            lat = np.array([func(g) for g in done])*1e3
+            print "%-10s %9.2f %9.2f %9.2f %9.2f" % (
+                (name,) + tuple(np.percentile(lat, [50, 90, 99])) +
+                (lat.max(),))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Stellarium server latency benchmark')
+    parser.add_argument('--clients', type=int, default=10,
+                        help='Number of client connections (default: 10)')
+    parser.add_argument('--rate', type=float, default=.5,
+                        help='Gotos per second of every client '
+                        '(default: 0.5)')
+    parser.add_argument('--duration', type=float, default=20.,
+                        help='Duration (s) of the benchmark (default: 20)')
+    parser.add_argument('--pos-rate', type=float, default=20.,
+                        help='Position broadcasts per second (default: 20)')
+    parser.add_argument('--catalog', default=CATALOG,
+                        help='Catalog of target stars')
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='Server port (default: %d)' % PORT)
+    parser.add_argument('--mock', action='store_true',
+                        help='Use a mock pointer instead of the emulator')
+    parser.add_argument('--mock-delay', type=float, default=0.,
+                        help='Time (s) for the mock pointer to reach a target')
+    parser.add_argument('--speed', type=float,
+                        help='Motor speed of the emulator (microsteps/s)')
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='Response latency (s) of the emulator')
+    parser.add_argument('--binary', action='store_true',
+                        help='Use the binary framing mode')
+    args = parser.parse_args()
 
+    logging.basicConfig(format='%(message)s', level=logging.WARNING)
+    if args.mock:
+        pointer = MockPointer(args.mock_delay)
+    else:
+        pointer = EmulatedPointer(args.speed, args.latency, args.binary)
 
-s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.connect((HOST, PORT))
+    bench = Benchmark(pointer, read_catalog(args.catalog), args.clients,
+                      args.rate, args.pos_rate, port=args.port)
+    bench.run(args.duration)
+    bench.report()
 
-stars = read_csv('ursa_maior.txt', sep=' ', header=None, names=['t', 'ra', 'dec', 'axis1', 'axis2'])
 
-while True:
-    for i in range(6):
-        for _, star in stars.iterrows():
-            data = encode_goto_packet([star.ra, star.dec])
-            print star.ra, star.dec
-            s.send(data)
-            time.sleep(2)
-    time.sleep(20)
+if __name__ == '__main__':
+    main()
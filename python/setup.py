@@ -12,12 +12,13 @@ setup(
     install_requires=['pyserial', 'numpy', 'rcfile'],
     author_email='juanmb@gmail.com',
     description='Software for controlling a motorized sky-pointing laser',
-    packages=['sky_pointer', 'sky_pointer.gui'],
+    packages=['sky_pointer', 'sky_pointer.gui', 'sky_pointer.cli'],
     platforms='any',
     entry_points={
         'console_scripts': [
-            #'skypointer = sky_pointer.cli.main:main',
+            'skypointer = sky_pointer.cli.main:main',
             'calc-pointer-errors = sky_pointer.calc_pointer_errors:main',
+            'skypointer-emulator = sky_pointer.emulator:main',
         ],
         'gui_scripts': [
             'skypointer-gui = sky_pointer.gui.main:main',
@@ -0,0 +1,41 @@
+"""Alignment snapshots, stored as JSON files. A snapshot contains the state
+of the pointing model, the calibration values and the homed motor positions
+the model refers to. The motors lose their position on shutdown, so after a
+restart the model is restored relative to the new homed positions and
+verified with a check star (see Pointer.load_alignment)."""
+
+import os
+import json
+import time
+from math import sin, cos, acos
+
+VERSION = 1
+
+
+def save_snapshot(path, model, calib, steps, hid=None):
+    """Write a snapshot. The file is replaced atomically, so a crash while
+    saving does not corrupt the previous one"""
+    snapshot = {'version': VERSION,
+                'time': time.time(),
+                'hid': hid,
+                'calib': list(calib),
+                'steps': list(steps),
+                'model': model}
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.rename(tmp, path)
+
+
+def load_snapshot(path):
+    with open(path) as f:
+        snapshot = json.load(f)
+    if snapshot.get('version') != VERSION:
+        raise ValueError("Unsupported alignment snapshot version")
+    return snapshot
+
+
+def angular_distance(a, b):
+    """Angle (rad) between two points given their spherical coordinates"""
+    c = sin(a[1])*sin(b[1]) + cos(a[1])*cos(b[1])*cos(a[0] - b[0])
+    return acos(max(-1., min(1., c)))
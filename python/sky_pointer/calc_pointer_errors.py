@@ -1,8 +1,11 @@
 import sys
 import argparse
+import multiprocessing
+import numpy as np
 from math import sqrt, pi, cos
-from scipy.optimize import fmin
+from scipy.optimize import fmin, least_squares
 from sky_pointer.pointing_model import PointingModel
+from sky_pointer.extended_model import ExtendedModel, DEFAULT_TERMS
 
 # List of observed stars for calibration.
 # Colums: time(hours), RA, dec, horiz. angle, elevation
@@ -47,11 +50,99 @@ def calc_errors(params, stars):
     return phi_err, theta_err
 
 
+def make_model(params, stars):
+    """Build a PointingModel aligned with the two first stars"""
+    z1, z2, z3 = params
+    pm = PointingModel(stars[0][0], z1, z2, z3)
+
+    for s in stars[:2]:
+        pm.set_ref(s[1:3], s[3:5], t=s[0])
+    return pm
+
+
+def calc_errors_array(params, stars):
+    """Vectorized version of calc_errors. stars must be a Nx5 array"""
+    pm = make_model(params, stars)
+    inst = pm.eq_to_inst_array(stars[:, 1:3], stars[:, 0])
+    # wrap the phi difference into [-pi, pi)
+    dphi = (inst[:, 0] - stars[:, 3] + pi) % (2*pi) - pi
+
+    phi_err = dphi*np.cos(inst[:, 1])*180/pi
+    theta_err = (inst[:, 1] - stars[:, 4])*180/pi
+    return phi_err, theta_err
+
+
 def func(params, stars):
     phi_err, theta_err = calc_errors(params, stars)
     # return chi-square
     return sum(sqrt(pe**2 + te**2) for pe, te in zip(phi_err, theta_err))
 
+
+def residuals(params, stars):
+    """Array of phi and theta errors of all stars"""
+    return np.concatenate(calc_errors_array(params, stars))
+
+
+def jacobian(params, stars, step=1e-7):
+    """Jacobian of residuals() with respect to z1, z2 and z3, computed by
+    forward differences (one batched evaluation per parameter)"""
+    r0 = residuals(params, stars)
+    jac = np.empty((len(r0), len(params)))
+    for i in range(len(params)):
+        p = np.array(params, dtype=float)
+        p[i] += step
+        jac[:, i] = (residuals(p, stars) - r0)/step
+    return jac
+
+
+def fit(stars, method='lsq', z=(.0, .0, .0)):
+    """Calculate the mount errors (z1, z2, z3) that best fit the observations.
+    method can be 'lsq' (least squares) or 'simplex' (downhill simplex
+    applied to the sum of distances)"""
+    if method == 'simplex':
+        return fmin(func, z, args=(stars,), full_output=0, xtol=2e-6)
+
+    stars = np.asarray(stars, dtype=float)
+    return least_squares(residuals, z, jac=jacobian, args=(stars,),
+                         x_scale=1e-3).x
+
+
+# observations shared with the bootstrap worker processes
+_bootstrap_stars = None
+
+
+def _bootstrap_init(stars):
+    global _bootstrap_stars
+    _bootstrap_stars = stars
+
+
+def _bootstrap_fit(args):
+    idx, method = args
+    return fit(_bootstrap_stars[idx], method)
+
+
+def bootstrap(stars, n, method='lsq', seed=None, processes=None):
+    """Fit the mount errors to n resampled sets of observations, using a pool
+    of processes. The two reference stars are kept in every sample and the
+    rest are drawn with replacement. Returns a nx3 array of estimates.
+    Results depend only on the seed, not on the number of processes."""
+    stars = np.asarray(stars, dtype=float)
+    rnd = np.random.RandomState(seed)
+    nstars = len(stars)
+    if nstars <= 2:
+        raise ValueError("The bootstrap needs more observations than the "
+                         "two reference stars")
+    samples = [(np.concatenate(([0, 1], rnd.randint(2, nstars, nstars - 2))),
+                method) for i in range(n)]
+
+    pool = multiprocessing.Pool(processes, _bootstrap_init, (stars,))
+    try:
+        return np.array(pool.map(_bootstrap_fit, samples))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def read_file(filename):
     lines = open(filename, 'r').readlines()
     observations = []
@@ -65,28 +156,69 @@ def main():
     parser = argparse.ArgumentParser(description=
             'Calculate mechanical errors from a collection of observations')
     parser.add_argument('file')
+    parser.add_argument('--method', '-m', choices=('lsq', 'simplex'),
+                        default='lsq', help='Fitting method (default: lsq)')
+    parser.add_argument('--bootstrap', '-b', type=int, default=0, metavar='N',
+                        help='Estimate uncertainties from N resampled fits')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed used for resampling')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='Number of processes (default: number of CPUs)')
+    parser.add_argument('--confidence', type=float, default=95.,
+                        help='Confidence level in %% (default: 95)')
+    parser.add_argument('--extended', '-e', action='store_true',
+                        help='Fit the terms of the extended pointing model')
+    parser.add_argument('--terms', default=','.join(DEFAULT_TERMS),
+                        help='Comma-separated list of extended model terms '
+                        '(default: %(default)s)')
     args = parser.parse_args()
 
-    #Initial guess.
-    z = (.0, .0, .0)
-
     observations = read_file(args.file)
     if not observations:
         print "Invalid or empty observations file!"
         return
 
-    # Apply downhill Simplex algorithm.
-    z = fmin(func, z, args=(observations,), full_output=0, xtol=2e-6)
+    z = fit(observations, args.method)
     print
     print "Mount errors (rad):", z
     print "Mount errors (deg):", z*180/pi
 
+    if args.bootstrap and len(observations) <= 2:
+        print
+        print "Not enough observations for the bootstrap"
+    elif args.bootstrap:
+        zs = bootstrap(observations, args.bootstrap, args.method, args.seed,
+                       args.jobs)
+        alpha = (100. - args.confidence)/2
+        low, high = np.percentile(zs, [alpha, 100. - alpha], axis=0)
+        print
+        print "Bootstrap (%d samples):" % args.bootstrap
+        for i in range(3):
+            print "z%d: %.6f +/- %.6f rad, %g%% CI [%.6f, %.6f]" % \
+                (i + 1, z[i], zs[:, i].std(ddof=1), args.confidence,
+                 low[i], high[i])
+        print "Covariance (rad^2):"
+        print np.cov(zs, rowvar=False)
+
+    if args.extended:
+        em = ExtendedModel(make_model(z, observations), args.terms.split(','))
+        try:
+            rms = em.fit(observations)
+        except ValueError as e:
+            print e
+        else:
+            print
+            print "Extended model terms (arcmin):"
+            for term, coef in zip(em.terms, em.coefs):
+                print "%-6s %8.3f" % (term, coef*180/pi*60)
+            print "RMS residual (arcmin): %.3f" % (rms*180/pi*60)
+
     try:
         import pylab
     except ImportError:
         pass
     else:
-        pe, te = calc_errors(z, observations)
+        pe, te = calc_errors_array(z, np.array(observations))
         pylab.plot(pe, te, 'ro')
         pylab.xlim([-.5, .5])
         pylab.ylim([-.5, .5])
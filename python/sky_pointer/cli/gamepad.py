@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
+import os
+import errno
 import logging
 import struct
 import time
-from threading import Timer
-from ..pointer import Pointer
+from ..pointer import AsyncPointer
 
 LOG_FILE = 'skypointer.log'
+LASER_TIME = 4      # Time (s) the laser is kept on after moving
+RUN_DELAY = .5      # Time (s) the joystick is held before running the motors
+EVENT = struct.Struct('IhBB')   # Linux joystick event
 
 
 def sign(val):
@@ -14,92 +18,141 @@ def sign(val):
 
 
 class Gamepad:
-    def __init__(self, pointer, device='/dev/input/js0'):
-        self.__pipe = open(device, 'r')
+    """Controls an AsyncPointer with a joystick device, which is read from an
+    EventLoop (the delayed actions are scheduled on it too)"""
+
+    def __init__(self, loop, pointer, device='/dev/input/js0'):
+        self.loop = loop
         self.ptr = pointer
+        self.__fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+        self.__buf = ''
+        self.__off_tmr = None
+        self.__run_tmr = None
         open(LOG_FILE, 'w').write("# timestamp\ttarget RA\ttarget dec\t"
                                   "inst phi\tinst theta\r\n")
+        loop.add_reader(self.__fd, self.__read)
 
-    def loop(self):
-        run_tmr = off_tmr = Timer(0, None)
+    def close(self):
+        if self.__fd is None:
+            return
+        self.__cancel_timers()
+        self.loop.remove_reader(self.__fd)
+        os.close(self.__fd)
+        self.__fd = None
 
-        while True:
-            t, value, _type, n = struct.unpack('IhBB', self.__pipe.read(8))
+    def __cancel_timers(self):
+        for tmr in (self.__off_tmr, self.__run_tmr):
+            if tmr:
+                tmr.cancel()
 
-            if _type == 1:
-                #logging.debug("Button %d %s" % (n, 'pressed' if value else 'released'))
-                if n == 0:
-                    off_tmr.cancel()
-                    self.ptr.enable_laser(value)
-                elif n == 1:
-                    if value:
-                        tgt = self.ptr.target
-                        inst = self.ptr.get_inst_coords()
-                        line = "%.3f\t%.6f\t%.6f\t%.6f\t%.6f" % \
-                            (time.time(), tgt[0], tgt[1], inst[0], inst[1])
-                        open(LOG_FILE, 'a').write(line+"\r\n")
-                        logging.info("Data written to %s:\n%s" % (LOG_FILE, line))
-                elif n in (4, 5):
-                    if value:
-                        index = n - 4
-                        refs = self.ptr.get_refs()
-
-                        if len(refs) > index:
-                            tgt = refs[index]
-                            logging.info("Going to target %d: %s" %
-                                          (index + 1, tgt))
-                            self.ptr.enable_laser(1)
-                            off_tmr.cancel()
-                            off_tmr = Timer(4, self.ptr.enable_laser, (0,))
-                            off_tmr.start()
-                            try:
-                                self.ptr.goto(tgt)
-                            except ValueError as e:
-                                logging.error(e)
-                elif n == 8:
-                    if value:
-                        logging.info("Setting reference star: %s" %
-                                      self.ptr.target)
-                        try:
-                            self.ptr.set_ref()
-                        except ValueError as e:
-                            logging.error(e)
+    def __laser(self, enable):
+        if self.__off_tmr:
+            self.__off_tmr.cancel()
+            self.__off_tmr = None
+        self.ptr.enable_laser(enable)
+
+    def __laser_off_later(self):
+        if self.__off_tmr:
+            self.__off_tmr.cancel()
+        self.__off_tmr = self.loop.call_later(LASER_TIME,
+                                              self.ptr.enable_laser, 0)
+
+    def __arrived(self, arrival):
+        """Show the target for a while and turn the laser off"""
+        if not arrival.cancelled():
+            self.__laser_off_later()
+
+    def __read(self):
+        try:
+            data = os.read(self.__fd, 64*EVENT.size)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            logging.error("Gamepad disconnected")
+            self.close()
+            return
 
+        self.__buf += data
+        n = len(self.__buf) - len(self.__buf) % EVENT.size
+        for i in range(0, n, EVENT.size):
+            t, value, _type, num = EVENT.unpack_from(self.__buf, i)
+            if _type == 1:
+                self.__button(num, value)
             elif _type == 2:
-                #logging.debug("Joystick %d. Value: %d" % (n, value))
-                if value:
-                    if n in (4, 5):
-                        off_tmr.cancel()
-                        self.ptr.enable_laser(1)
-                        run_tmr.cancel()
-                        _dir = sign(-value)
-                        if n == 4:
-                            self.ptr.steps(_dir, 0)
-                            run_tmr = Timer(.5, self.ptr.run, (_dir, 0))
-                        else:
-                            self.ptr.steps(0, _dir)
-                            run_tmr = Timer(.5, self.ptr.run, (0, _dir))
-                        run_tmr.start()
+                self.__axis(num, value)
+        self.__buf = self.__buf[n:]
+
+    def __log_data(self, inst):
+        tgt = self.ptr.target
+        line = "%.3f\t%.6f\t%.6f\t%.6f\t%.6f" % \
+            (time.time(), tgt[0], tgt[1], inst[0], inst[1])
+        open(LOG_FILE, 'a').write(line+"\r\n")
+        logging.info("Data written to %s:\n%s" % (LOG_FILE, line))
+
+    def __button(self, n, value):
+        if n == 0:
+            self.__laser(value)
+        elif n == 1:
+            if value:
+                self.ptr.get_inst_coords(exact=True).then(self.__log_data)
+        elif n in (4, 5):
+            if value:
+                index = n - 4
+                refs = self.ptr.get_refs()
+
+                if len(refs) > index:
+                    tgt = refs[index]['eq']
+                    logging.info("Going to target %d: %s" % (index + 1, tgt))
+                    self.__laser(1)
+                    try:
+                        arrival = self.ptr.goto(tgt)
+                    except ValueError as e:
+                        logging.error(e)
+                        return
+                    arrival.add_done_callback(self.__arrived)
+        elif n == 8:
+            if value:
+                logging.info("Setting reference star: %s" % self.ptr.target)
+                self.ptr.set_ref().add_done_callback(
+                    lambda f: f.exception() and logging.error(f.exception()))
+
+    def __axis(self, n, value):
+        if value:
+            if n in (4, 5):
+                self.__laser(1)
+                if self.__run_tmr:
+                    self.__run_tmr.cancel()
+                _dir = sign(-value)
+                if n == 4:
+                    self.ptr.steps(_dir, 0)
+                    self.__run_tmr = self.loop.call_later(
+                        RUN_DELAY, self.ptr.run, _dir, 0)
                 else:
-                    off_tmr.cancel()
-                    off_tmr = Timer(4, self.ptr.enable_laser, (0,))
-                    off_tmr.start()
-                    run_tmr.cancel()
-                    self.ptr.stop()
-            else:
-                pass
-                #logging.debug("Key %d. Value: %d" % (n, value))
+                    self.ptr.steps(0, _dir)
+                    self.__run_tmr = self.loop.call_later(
+                        RUN_DELAY, self.ptr.run, 0, _dir)
+        else:
+            self.__laser_off_later()
+            if self.__run_tmr:
+                self.__run_tmr.cancel()
+                self.__run_tmr = None
+            self.ptr.stop()
 
 
 if __name__ == '__main__':
+    from ..eventloop import EventLoop
     logging.basicConfig(format='%(message)s', level=logging.DEBUG)
     dev = '/dev/input/by-id/usb-Gasia_Co._Ltd_PS_R__Gamepad-joystick'
 
-    ptr = Pointer()
-    pad = Gamepad(ptr, dev)
-    logging.info("Hardware:", ptr.hid)
+    loop = EventLoop()
+    ptr = AsyncPointer(loop)
+    loop.run_until_complete(ptr.open())
+    pad = Gamepad(loop, ptr, dev)
+    logging.info("Hardware: %s" % ptr.hid)
 
     try:
-        pad.loop()
+        loop.run_forever()
     except KeyboardInterrupt:
         logging.info("Close")
@@ -2,14 +2,74 @@
 
 import logging
 import argparse
-import threading
 from rcfile import rcfile
-from ..server import Server
-from ..pointer import Pointer
+from ..eventloop import EventLoop
+from ..server import StellariumServer
+from ..pointer import AsyncPointer
 from gamepad import Gamepad
 
 SERIAL_PORT = '/dev/ttyUSB0'
 JOYSTICK_DEV = '/dev/js0'
+POS_PERIOD = .1     # Time (s) between updates of the position sent to clients
+CLOSE_TIMEOUT = 2.  # Max. time (s) waiting for the pointer when closing
+
+
+class Daemon(object):
+    """Runs the pointer, the Stellarium server and the gamepad on a single
+    EventLoop.
+
+    joystick: joystick device (None for running without a gamepad)
+    track: keep tracking the targets received from Stellarium
+    """
+
+    def __init__(self, loop, serial=SERIAL_PORT, iface='0.0.0.0', port=10001,
+                 joystick=None, track=False):
+        self.loop = loop
+        self.ptr = AsyncPointer(loop, serial)
+        self.server = StellariumServer(iface, port, goto=self.goto, loop=loop)
+        self.pad = None
+        self.joystick = joystick
+        self.track = track
+        self.__timer = None
+
+    def start(self):
+        """Connect to the pointer. Returns a Future completed when done"""
+        return self.ptr.open().then(self.__opened)
+
+    def __opened(self, ret):
+        logging.info("Connected to %s" % self.ptr.hid)
+        if self.joystick:
+            try:
+                self.pad = Gamepad(self.loop, self.ptr, self.joystick)
+            except (IOError, OSError) as e:
+                logging.error("Cannot open the gamepad: %s" % e)
+        self.__update_pos()
+
+    def goto(self, eq):
+        if self.ptr.hid is None:
+            logging.error("The pointer is not connected")
+            return
+        try:
+            if self.track:
+                self.ptr.track(eq)
+            else:
+                self.ptr.goto(eq)
+        except ValueError as e:
+            logging.error(e)
+
+    def __update_pos(self):
+        if len(self.ptr.get_refs()) >= 2:
+            self.ptr.get_coords().then(self.server.set_pos)
+        self.__timer = self.loop.call_later(POS_PERIOD, self.__update_pos)
+
+    def close(self):
+        """Close the devices. Returns the Future of the pointer closing"""
+        if self.__timer:
+            self.__timer.cancel()
+        if self.pad:
+            self.pad.close()
+        self.server.close()
+        return self.ptr.close()
 
 
 def main():
@@ -33,22 +93,32 @@ def main():
                         help='Serial port (default: %s)' % serial)
     parser.add_argument('--joystick', '-j', default=joystick,
                         help='Joystick device (default: %s)' % joystick)
+    parser.add_argument('--no-joystick', action='store_true',
+                        help='Run without a gamepad')
+    parser.add_argument('--track', '-t', action='store_true',
+                        help='Keep tracking the targets')
     args = parser.parse_args()
 
-    ptr = Pointer(args.serial)
-    pad = Gamepad(ptr, args.joystick)
-
-    server = Server(ptr, args.iface, args.port)
+    loop = EventLoop()
+    daemon = Daemon(loop, args.serial, args.iface, args.port,
+                    None if args.no_joystick else args.joystick, args.track)
     logging.info("Server listening on port %d" % args.port)
 
-    pad_thread = threading.Thread(target=pad.loop)
-    pad_thread.daemon = True
-    pad_thread.start()
+    def started(f):
+        if f.exception() is not None:
+            logging.error("Cannot connect to the pointer: %s" % f.exception())
+            loop.stop()
+    daemon.start().add_done_callback(started)
 
     try:
-        server.serve_forever()
+        loop.run_forever()
     except KeyboardInterrupt:
         logging.info("Closing")
+    try:
+        loop.run_until_complete(daemon.close(), CLOSE_TIMEOUT)
+    except IOError as e:
+        logging.error(e)
+    loop.close()
 
 
 if __name__ == "__main__":
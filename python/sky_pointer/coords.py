@@ -1,7 +1,17 @@
+import numpy as np
 from math import pi, copysign, modf, floor
 
+TOLERANCE = 1e-9    # max. difference (rad) between coords considered equal
+
+
+def _angle_diff(a, b):
+    """Difference between two angles (or arrays of angles) in [-pi, pi)"""
+    return (a - b + pi) % (2*pi) - pi
+
 
 class Coords(object):
+    __slots__ = ('x', 'y')
+
     def __init__(self, x, y):
         """x, y must be radians"""
         self.x, self.y = x, y
@@ -14,15 +24,27 @@ class Coords(object):
         else:
             raise IndexError("Invalid index: %s" % key)
 
+    def __len__(self):
+        return 2
+
+    def isclose(self, other, tol=TOLERANCE):
+        """Check if two coords are equal within a tolerance (rad)"""
+        return (abs(_angle_diff(self.x, other[0])) <= tol
+                and abs(self.y - other[1]) <= tol)
+
     def __eq__(self, other):
-        return (isinstance(other, self.__class__)
-                and self.__dict__ == other.__dict__)
+        return isinstance(other, self.__class__) and self.isclose(other)
+
+    def __ne__(self, other):
+        return not self == other
 
     def __str__(self):
         return 'X: %3.4f deg\tY: %3.4f deg' % (180/pi*self.x, 180/pi*self.y)
 
 
 class EqCoords(Coords):
+    __slots__ = ()
+
     def fields(self):
         hfrac, ra_h = modf(abs(self.x*12/pi))
         mfrac, ra_m = modf(hfrac*60.)
@@ -44,6 +66,95 @@ class EqCoords(Coords):
         return EqCoords(ra*pi/12, dec*pi/180)
 
 
+class CoordsArray(object):
+    """An array of coords backed by a contiguous (N, 2) float64 NumPy array.
+    Creating it from (or converting it to) such an array does not copy the
+    data, so it can be passed directly to the batch methods of PointingModel
+    """
+    __slots__ = ('data',)
+    item_class = Coords
+
+    def __init__(self, data=()):
+        data = np.ascontiguousarray(data, dtype=np.float64)
+        if data.ndim != 2 or data.shape[1] != 2:
+            data = data.reshape(-1, 2)
+        self.data = data
+
+    @classmethod
+    def from_list(cls, coords):
+        """Build an array from a sequence of Coords objects"""
+        return cls([(c[0], c[1]) for c in coords])
+
+    @property
+    def x(self):
+        return self.data[:, 0]
+
+    @property
+    def y(self):
+        return self.data[:, 1]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, np.integer)):
+            return self.item_class(*self.data[key])
+        return self.__class__(self.data[key])
+
+    def __iter__(self):
+        for x, y in self.data:
+            yield self.item_class(x, y)
+
+    def __array__(self, dtype=None):
+        return self.data if dtype is None else self.data.astype(dtype)
+
+    def isclose(self, other, tol=TOLERANCE):
+        """Element-wise comparison within a tolerance (rad)"""
+        other = np.asarray(other, dtype=np.float64).reshape(-1, 2)
+        return ((abs(_angle_diff(self.data[:, 0], other[:, 0])) <= tol)
+                & (abs(self.data[:, 1] - other[:, 1]) <= tol))
+
+    def __str__(self):
+        return '\n'.join(str(c) for c in self)
+
+
+class EqCoordsArray(CoordsArray):
+    __slots__ = ()
+    item_class = EqCoords
+
+    def fields(self):
+        """Vectorized version of EqCoords.fields. Returns a Nx6 array"""
+        ra = np.abs(self.x*12/pi)
+        ra_h = np.floor(ra)
+        ra_m = np.floor((ra - ra_h)*60.)
+        ra_s = np.floor(((ra - ra_h)*60. - ra_m)*60)
+
+        dec = np.abs(self.y*180/pi)
+        dec_d = np.floor(dec)
+        dec_m = np.floor((dec - dec_d)*60.)
+        dec_s = np.floor(((dec - dec_d)*60. - dec_m)*60)
+
+        return np.column_stack((ra_h % 24, ra_m, ra_s,
+                                np.copysign(dec_d, self.y), dec_m, dec_s))
+
+    def format(self):
+        """Get a list of sexagesimal strings, like str(EqCoords)"""
+        return ['RA: %02d:%02d:%02.0f\tdec: %02d:%02d:%02.0f' % tuple(f)
+                for f in self.fields()]
+
+    def __str__(self):
+        return '\n'.join(self.format())
+
+    @classmethod
+    def from_fields(cls, fields):
+        """Build an array from a Nx6 array of fields (see EqCoords.fields)"""
+        f = np.asarray(fields, dtype=np.float64).reshape(-1, 6)
+        ra = np.copysign(np.abs(f[:, 0]) + f[:, 1]/60. + f[:, 2]/3600., f[:, 0])
+        dec = np.copysign(np.abs(f[:, 3]) + f[:, 4]/60. + f[:, 5]/3600.,
+                          f[:, 3])
+        return cls(np.column_stack((ra*pi/12, dec*pi/180)))
+
+
 if __name__ == '__main__':
     eq1 = EqCoords(-pi - pi/12./60, pi/2 + pi/180./60*2)
     print eq1
@@ -57,3 +168,11 @@ if __name__ == '__main__':
     print Coords(1, 2) == Coords(1, 2)
 
     print EqCoords(pi/12, -1*pi/180)
+    print
+
+    eqs = EqCoordsArray([(pi/12, -pi/180), (pi, pi/4), (-pi/3, 0.1234)])
+    print eqs
+    print eqs[1:]
+    print eqs[0] == EqCoords(pi/12, -pi/180)
+    print np.asarray(eqs) is eqs.data, EqCoordsArray(eqs.data).data is eqs.data
+    print all(a.fields() == tuple(b) for a, b in zip(eqs, eqs.fields()))
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+import os
+import pty
+import tty
+import json
+import time
+import struct
+import random
+import select
+import logging
+import argparse
+import threading
+import framing
+from framing import MOTION, POS, CALIB, INDEX
+from protocol import STEPS, BINARY_CAP
+from position import Axis, SPEED
+
+ID = 'SkyPointer 1.0'
+
+
+class Emulator(object):
+    """Software emulation of the SkyPointer firmware. It speaks the same ASCII
+    protocol as the board through a pseudo-terminal, whose path (the port
+    attribute) can be opened with Protocol or Pointer.
+
+    speed: motor speed (microsteps/s) of both axes, or a (ha, el) tuple
+    latency: delay (s) before sending each response
+    drop_rate: probability of losing each byte of a response
+    eeprom: JSON file where the calibration values are stored
+    boot_time: time (s) during which the commands are ignored after
+    starting, like the Arduino bootloader does
+    binary: support the binary framing mode (command 'B <push period ms>')
+    """
+
+    def __init__(self, speed=SPEED, latency=0., drop_rate=0., eeprom=None,
+                 boot_time=0., seed=None, binary=False):
+        ha_speed, el_speed = speed if hasattr(speed, '__len__') \
+            else (speed, speed)
+        self.axes = Axis(ha_speed), Axis(el_speed)
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.eeprom_file = eeprom
+        self.boot_time = boot_time
+        self.laser = False
+        self.eeprom = {}
+        self.random = random.Random(seed)
+        self.id = ID + ' ' + BINARY_CAP if binary else ID
+        self.push_period = 0.
+        self.__binary = False
+        self.__parser = framing.FrameParser()
+
+        if eeprom and os.path.exists(eeprom):
+            self.eeprom = dict((int(k), v) for k, v in
+                               json.load(open(eeprom)).items())
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.__running = False
+        self.__thread = None
+        self.__start_t = 0
+
+    def start(self):
+        self.__running = True
+        self.__start_t = time.time()
+        self.__thread = threading.Thread(target=self.__serve)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__running = False
+        if self.__thread:
+            self.__thread.join()
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def get_pos(self, t=0):
+        t = t or time.time()
+        return tuple(int(round(axis.get_pos(t))) % STEPS for axis in self.axes)
+
+    def is_moving(self, t=0):
+        t = t or time.time()
+        return any(axis.is_moving(t) for axis in self.axes)
+
+    def __serve(self):
+        buf = ''
+        next_push = 0
+        was_moving = False
+        while self.__running:
+            pushing = self.__binary and self.push_period
+            rlist, _, _ = select.select([self.master], [], [],
+                                        .01 if pushing else .1)
+
+            # send the position periodically while moving (binary mode)
+            now = time.time()
+            if pushing and now >= next_push:
+                moving = self.is_moving(now)
+                if moving or was_moving:
+                    self.__write(framing.encode_frame(
+                        framing.PUSH_POS, POS.pack(*self.get_pos(now))))
+                was_moving = moving
+                next_push = now + self.push_period
+
+            if not rlist:
+                continue
+            buf += os.read(self.master, 1024)
+
+            while '\r' in buf and not self.__binary:
+                cmd, buf = buf.split('\r', 1)
+                if time.time() - self.__start_t < self.boot_time:
+                    continue
+                resp = self.process(cmd.strip())
+                if resp is None:
+                    continue
+                if self.latency:
+                    time.sleep(self.latency)
+                self.__write(resp + '\n')
+                if cmd.startswith('B') and resp == 'OK':
+                    self.__binary = True
+
+            if self.__binary and buf:
+                for frame in self.__parser.feed(buf):
+                    opcode, payload = self.process_frame(frame)
+                    if self.latency:
+                        time.sleep(self.latency)
+                    self.__write(framing.encode_frame(opcode, payload))
+                buf = ''
+
+    def __write(self, data):
+        if self.drop_rate:
+            data = ''.join(c for c in data
+                           if self.random.random() >= self.drop_rate)
+        os.write(self.master, data)
+
+    def process(self, cmd):
+        """Execute a command and return the response"""
+        t = time.time()
+        words = cmd.split()
+        if not words:
+            return None
+        try:
+            args = [int(w) for w in words[1:]] if words[0] != 'W' else \
+                [int(words[1]), int(words[2], 16)]
+        except (ValueError, IndexError):
+            return 'ERROR'
+
+        c = words[0]
+        if c == 'I':
+            return self.id
+        elif c == 'B' and len(args) == 1 and self.id != ID:
+            self.push_period = args[0]/1000.
+        elif c == 'P':
+            return 'P %04d %04d' % self.get_pos(t)
+        elif c == 'R' and len(args) == 1:
+            return 'R %08x' % self.eeprom.get(args[0], 0)
+        elif c == 'W' and len(args) == 2:
+            self.eeprom[args[0]] = args[1]
+            if self.eeprom_file:
+                json.dump(self.eeprom, open(self.eeprom_file, 'w'))
+        elif c == 'L' and len(args) == 1:
+            self.laser = bool(args[0])
+        elif c == 'G' and len(args) == 2:
+            for axis, pos in zip(self.axes, args):
+                axis.goto(pos, t)
+        elif c == 'M' and len(args) == 2:
+            for axis, delta in zip(self.axes, args):
+                axis.move(delta, t)
+        elif c == 'H' and not args:
+            for axis in self.axes:
+                axis.goto(0, t)
+        elif c in ('S', 'Q') and not args:
+            for axis in self.axes:
+                axis.stop(t)
+        else:
+            return 'ERROR'
+        return 'OK'
+
+    def process_frame(self, frame):
+        """Execute a binary command. Returns the opcode and the payload of the
+        response"""
+        opcode, payload = frame[0], frame[1:]
+        try:
+            if opcode in 'GM':
+                args = MOTION.unpack(payload)
+            elif opcode in 'LR':
+                args = INDEX.unpack(payload)
+            elif opcode == 'W':
+                n, val = CALIB.unpack(payload)
+                args = n, '%x' % struct.unpack('!I', struct.pack('!f', val))[0]
+            elif payload:
+                raise struct.error
+            else:
+                args = ()
+        except struct.error:
+            return framing.ERROR, opcode
+
+        resp = self.process(' '.join([opcode] + [str(a) for a in args]))
+        if resp == 'ERROR':
+            return framing.ERROR, opcode
+        elif opcode == 'I':
+            return opcode, resp
+        elif opcode == 'P':
+            return opcode, POS.pack(*[int(w) for w in resp.split()[1:]])
+        elif opcode == 'R':
+            v = int(resp.split()[1], 16)
+            val = struct.unpack('!f', struct.pack('!I', v))[0]
+            return opcode, CALIB.pack(args[0], val)
+        return opcode, ''
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='SkyPointer firmware emulator')
+    parser.add_argument('--speed', type=float, default=SPEED,
+                        help='Motor speed (microsteps/s, default: %g)' % SPEED)
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='Response latency (s)')
+    parser.add_argument('--drop-rate', type=float, default=0.,
+                        help='Probability of losing a response byte')
+    parser.add_argument('--eeprom', help='File for the calibration values')
+    parser.add_argument('--boot-time', type=float, default=0.,
+                        help='Time (s) ignoring commands after starting')
+    parser.add_argument('--seed', type=int, help='Random seed')
+    parser.add_argument('--binary', action='store_true',
+                        help='Support the binary framing mode')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    emu = Emulator(args.speed, args.latency, args.drop_rate, args.eeprom,
+                   args.boot_time, args.seed, args.binary)
+    emu.start()
+    logging.info("Emulator listening on %s" % emu.port)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info("Closing")
+    emu.close()
+
+
+if __name__ == '__main__':
+    main()
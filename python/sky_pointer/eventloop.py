@@ -0,0 +1,191 @@
+import os
+import time
+import heapq
+import select
+import logging
+import threading
+from future import Future
+
+
+class Handle(object):
+    """A scheduled callback, which can be cancelled"""
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when, self.callback, self.args = when, callback, args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+
+class EventLoop(object):
+    """A minimal single-threaded event loop, with an API modelled after
+    asyncio's: file descriptor readers and writers, delayed calls and
+    thread-safe wakeups. It uses poll() when available and select()
+    otherwise."""
+
+    def __init__(self):
+        self.__readers = {}
+        self.__writers = {}
+        self.__timers = []
+        self.__ready = []
+        self.__lock = threading.Lock()
+        self.__running = False
+        self.__poll = select.poll() if hasattr(select, 'poll') else None
+
+        # self-pipe used for waking up the loop from other threads
+        self.__wake_r, self.__wake_w = os.pipe()
+        self.add_reader(self.__wake_r, self.__on_wake)
+
+    def time(self):
+        return time.time()
+
+    def __update(self, fd):
+        if self.__poll is None:
+            return
+        mask = (select.POLLIN if fd in self.__readers else 0) | \
+            (select.POLLOUT if fd in self.__writers else 0)
+        if mask:
+            self.__poll.register(fd, mask)
+        else:
+            try:
+                self.__poll.unregister(fd)
+            except KeyError:
+                pass
+
+    def add_reader(self, fd, callback, *args):
+        self.__readers[fd] = callback, args
+        self.__update(fd)
+
+    def remove_reader(self, fd):
+        self.__readers.pop(fd, None)
+        self.__update(fd)
+
+    def add_writer(self, fd, callback, *args):
+        self.__writers[fd] = callback, args
+        self.__update(fd)
+
+    def remove_writer(self, fd):
+        self.__writers.pop(fd, None)
+        self.__update(fd)
+
+    def call_soon(self, callback, *args):
+        handle = Handle(0, callback, args)
+        self.__ready.append(handle)
+        return handle
+
+    def call_soon_threadsafe(self, callback, *args):
+        with self.__lock:
+            handle = self.call_soon(callback, *args)
+        os.write(self.__wake_w, 'x')
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        """Call callback(*args) after delay seconds. Like call_at, it must
+        be called from the loop thread"""
+        return self.call_at(self.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        """Call callback(*args) at the given time. The timers are not
+        thread-safe: from other threads, use call_soon_threadsafe to
+        schedule the call"""
+        handle = Handle(when, callback, args)
+        heapq.heappush(self.__timers, handle)
+        return handle
+
+    def wrap_future(self, future):
+        """Return a future completed in the loop thread when the given one
+        (which may be completed by any thread) is done"""
+        wrapped = Future()
+        future.add_done_callback(
+            lambda f: self.call_soon_threadsafe(wrapped.copy_from, f))
+        return wrapped
+
+    def __on_wake(self):
+        os.read(self.__wake_r, 4096)
+
+    def __wait(self, timeout):
+        if self.__poll is not None:
+            events = self.__poll.poll(None if timeout is None
+                                      else int(timeout*1000 + .999))
+            ready = []
+            for fd, mask in events:
+                if mask & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                    ready.append((fd, self.__readers))
+                if mask & (select.POLLOUT | select.POLLERR):
+                    ready.append((fd, self.__writers))
+            return ready
+
+        rlist, wlist, _ = select.select(self.__readers.keys(),
+                                        self.__writers.keys(), [], timeout)
+        return [(fd, self.__readers) for fd in rlist] + \
+            [(fd, self.__writers) for fd in wlist]
+
+    def run_once(self):
+        # drop the cancelled timers, so they don't wake up the loop
+        while self.__timers and self.__timers[0].cancelled:
+            heapq.heappop(self.__timers)
+
+        with self.__lock:
+            timeout = None
+            if self.__ready:
+                timeout = 0
+            elif self.__timers:
+                timeout = max(0, self.__timers[0].when - self.time())
+
+        for fd, callbacks in self.__wait(timeout):
+            if fd in callbacks:
+                callback, args = callbacks[fd]
+                self.__run(callback, args)
+
+        now = self.time()
+        while self.__timers and self.__timers[0].when <= now:
+            handle = heapq.heappop(self.__timers)
+            if not handle.cancelled:
+                self.__run(handle.callback, handle.args)
+
+        with self.__lock:
+            ready, self.__ready = self.__ready, []
+        for handle in ready:
+            if not handle.cancelled:
+                self.__run(handle.callback, handle.args)
+
+    def __run(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception("Exception in event loop callback")
+
+    def run_forever(self):
+        self.__running = True
+        while self.__running:
+            self.run_once()
+
+    def run_until_complete(self, future, timeout=None):
+        """Run the loop until the future is done and return its result"""
+        handle = None
+        if timeout is not None:
+            handle = self.call_later(timeout, future.set_exception,
+                                     IOError("Operation timed out"))
+        try:
+            while not future.done():
+                self.run_once()
+        finally:
+            if handle:
+                handle.cancel()
+        return future.result()
+
+    def __halt(self):
+        self.__running = False
+
+    def stop(self):
+        self.call_soon_threadsafe(self.__halt)
+
+    def close(self):
+        self.remove_reader(self.__wake_r)
+        os.close(self.__wake_r)
+        os.close(self.__wake_w)
@@ -0,0 +1,145 @@
+import numpy as np
+from math import pi
+from coords import Coords, EqCoords
+
+# Terms of the extended pointing model, in the spirit of TPOINT. Each function
+# takes the arrays of instrumental coordinates (A: horizontal angle, E:
+# elevation) and returns the contribution of a unit coefficient to the
+# horizontal error measured on the sky (dA*cos(E)) and to the elevation error
+# (dE). All coefficients are in radians.
+TERMS = {
+    # encoder index offsets
+    'IA': lambda A, E: (np.cos(E), np.zeros_like(E)),
+    'IE': lambda A, E: (np.zeros_like(E), np.ones_like(E)),
+    # non-perpendicularity of the laser and the elevation axis (collimation)
+    'CA': lambda A, E: (np.ones_like(E), np.zeros_like(E)),
+    # non-perpendicularity of the horizontal and elevation axes
+    'NPAE': lambda A, E: (np.sin(E), np.zeros_like(E)),
+    # tilt of the vertical axis (north-south and east-west)
+    'AN': lambda A, E: (np.sin(A)*np.sin(E), np.cos(A)),
+    'AW': lambda A, E: (np.cos(A)*np.sin(E), -np.sin(A)),
+    # tube flexure
+    'TF': lambda A, E: (np.zeros_like(E), np.cos(E)),
+    # axis wobble harmonics
+    'HASA': lambda A, E: (np.sin(A)*np.cos(E), np.zeros_like(E)),
+    'HACA': lambda A, E: (np.cos(A)*np.cos(E), np.zeros_like(E)),
+    'HESA': lambda A, E: (np.zeros_like(E), np.sin(A)),
+    'HECA': lambda A, E: (np.zeros_like(E), np.cos(A)),
+    'HASA2': lambda A, E: (np.sin(2*A)*np.cos(E), np.zeros_like(E)),
+    'HACA2': lambda A, E: (np.cos(2*A)*np.cos(E), np.zeros_like(E)),
+    'HESA2': lambda A, E: (np.zeros_like(E), np.sin(2*A)),
+    'HECA2': lambda A, E: (np.zeros_like(E), np.cos(2*A)),
+}
+
+DEFAULT_TERMS = ('IA', 'IE', 'CA', 'NPAE', 'AN', 'AW', 'TF',
+                 'HASA', 'HACA', 'HESA', 'HECA')
+
+
+class ExtendedModel(object):
+    """ A PointingModel with additional error terms. The terms are applied as
+    small corrections to the instrumental coordinates computed by the
+    PointingModel, and their coefficients are obtained by linear least squares
+    from a set of observations.
+    """
+
+    def __init__(self, pm, terms=DEFAULT_TERMS, coefs=None):
+        for term in terms:
+            if term not in TERMS:
+                raise ValueError("Unknown pointing term: %s" % term)
+        self.pm = pm
+        self.terms = tuple(terms)
+        self.coefs = np.zeros(len(terms)) if coefs is None else \
+            np.array(coefs, dtype=float)
+
+    def get_terms(self):
+        """ Return a dictionary with the coefficient of every term """
+        return dict(zip(self.terms, self.coefs))
+
+    def design_matrix(self, inst):
+        """ Get the 2Nx(number of terms) matrix that gives the errors on the sky
+        (the N horizontal errors followed by the N elevation errors) at the
+        Nx2 instrumental coordinates inst """
+        inst = np.asarray(inst, dtype=float).reshape(-1, 2)
+        A, E = inst[:, 0], inst[:, 1]
+        columns = [np.concatenate(TERMS[term](A, E)) for term in self.terms]
+        return np.column_stack(columns)
+
+    def corrections(self, inst):
+        """ Get the Nx2 array of corrections (dA, dE) to apply to the Nx2
+        instrumental coordinates inst """
+        inst = np.asarray(inst, dtype=float).reshape(-1, 2)
+        err = self.design_matrix(inst).dot(self.coefs).reshape(2, -1)
+        cos_e = np.maximum(np.cos(inst[:, 1]), 1e-3)
+        return np.column_stack((err[0]/cos_e, err[1]))
+
+    def fit(self, observations):
+        """ Calculate the coefficients of the terms from a set of
+        observations. Each row has the same columns as the log files:
+        timestamp, RA, dec, horizontal angle and elevation. Returns the RMS of
+        the residual errors on the sky (rad) """
+        obs = np.asarray(observations, dtype=float).reshape(-1, 5)
+        if 2*len(obs) < len(self.terms):
+            raise ValueError("Not enough observations")
+
+        ideal = self.pm.eq_to_inst_array(obs[:, 1:3], obs[:, 0])
+        # wrap the horizontal error into [-pi, pi)
+        da = (obs[:, 3] - ideal[:, 0] + pi) % (2*pi) - pi
+        err = np.concatenate((da*np.cos(ideal[:, 1]), obs[:, 4] - ideal[:, 1]))
+
+        M = self.design_matrix(ideal)
+        self.coefs = np.linalg.lstsq(M, err, rcond=None)[0]
+        return np.sqrt(np.mean((err - M.dot(self.coefs))**2))
+
+    def eq_to_inst_array(self, eq, t=0):
+        """ Convert an Nx2 array of equatorial coordinates to an Nx2 array of
+        instrumental coordinates """
+        ideal = self.pm.eq_to_inst_array(eq, t)
+        return ideal + self.corrections(ideal)
+
+    def inst_to_eq_array(self, inst, t=0, niter=3):
+        """ Convert an Nx2 array of instrumental coordinates to an Nx2 array
+        of equatorial coordinates """
+        inst = np.asarray(inst, dtype=float).reshape(-1, 2)
+        # the corrections depend on the ideal coords, so they are found
+        # by fixed-point iteration
+        ideal = inst
+        for i in range(niter):
+            ideal = inst - self.corrections(ideal)
+        return self.pm.inst_to_eq_array(ideal, t)
+
+    def eq_to_inst(self, eq, t=0):
+        """ Convert equatorial to instrumental coordinates"""
+        return Coords(*self.eq_to_inst_array([eq[0], eq[1]], t)[0])
+
+    def inst_to_eq(self, inst, t=0):
+        """ Convert instrumental to equatorial coordinates"""
+        return EqCoords(*self.inst_to_eq_array([inst[0], inst[1]], t)[0])
+
+
+if __name__ == '__main__':
+    from pointing_model import PointingModel
+
+    # generate fake observations with known errors
+    pm = PointingModel(t=75600)
+    pm.set_ref([0.034470, 0.506809], [1.732239, 1.463808], t=77276)
+    pm.set_ref([0.618501, 1.557218], [5.427625, 0.611563], t=77780.75)
+
+    rnd = np.random.RandomState(0)
+    n = 200
+    eq = rnd.uniform([0, -pi/2], [2*pi, pi/2], (n, 2))
+    ts = np.linspace(78000, 79000, n)
+    true = ExtendedModel(pm, coefs=rnd.normal(0, 1e-3, len(DEFAULT_TERMS)))
+    inst = true.eq_to_inst_array(eq, ts)
+    inst += rnd.normal(0, 1e-5, inst.shape)
+    observations = np.column_stack((ts, eq, inst))
+
+    em = ExtendedModel(pm)
+    rms = em.fit(observations)
+    print "RMS error: %.2f arcsec" % (rms*180/pi*3600)
+    for term, coef, true_coef in zip(em.terms, em.coefs, true.coefs):
+        print "%-6s %9.6f (%9.6f)" % (term, coef, true_coef)
+
+    back = em.inst_to_eq_array(em.eq_to_inst_array(eq[:5], ts[:5]), ts[:5])
+    diff = back - eq[:5]
+    diff[:, 0] = (diff[:, 0] + pi) % (2*pi) - pi
+    print "Round trip error:", abs(diff).max()
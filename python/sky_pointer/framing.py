@@ -0,0 +1,111 @@
+"""Binary framing used by the serial protocol when both sides support it.
+
+Every frame has the following format:
+
+    SYNC (0xA5) | LEN | OPCODE | PAYLOAD (LEN bytes) | CRC8
+
+The CRC (polynomial 0x07) is calculated over LEN, OPCODE and PAYLOAD. The
+opcodes are the letters of the ASCII commands. The response to a command has
+the same opcode, or ERROR followed by the opcode of the failed command.
+"""
+
+import struct
+
+SYNC = 0xA5
+MAX_PAYLOAD = 32
+
+ERROR = 'E'         # opcode of error responses
+PUSH_POS = 'p'      # opcode of the position frames sent by the board
+
+# payloads
+MOTION = struct.Struct('<hh')   # goto and move commands
+POS = struct.Struct('<HH')      # position responses and push frames
+CALIB = struct.Struct('<Bf')    # calibration value (index and value)
+INDEX = struct.Struct('<B')     # calibration index, laser state
+
+
+def _crc8_table(poly=0x07):
+    table = []
+    for i in range(256):
+        crc = i
+        for j in range(8):
+            crc = ((crc << 1) ^ poly if crc & 0x80 else crc << 1) & 0xff
+        table.append(crc)
+    return table
+
+_CRC8_TABLE = _crc8_table()
+
+
+def crc8(data, start=0, end=None):
+    """CRC-8 of a bytearray (or a slice of it)"""
+    crc = 0
+    table = _CRC8_TABLE
+    for i in xrange(start, len(data) if end is None else end):
+        crc = table[crc ^ data[i]]
+    return crc
+
+
+def encode_frame(opcode, payload=''):
+    """Build a frame from an opcode and a payload (strings)"""
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError("Payload too long")
+    frame = bytearray(len(payload) + 4)
+    frame[0] = SYNC
+    frame[1] = len(payload)
+    frame[2] = ord(opcode)
+    frame[3:-1] = payload
+    frame[-1] = crc8(frame, 1, len(frame) - 1)
+    return str(frame)
+
+
+class FrameParser(object):
+    """Incremental frame decoder. Data is appended to a preallocated buffer,
+    and every complete frame with a valid CRC is returned as a string
+    containing the opcode followed by the payload. Garbage and corrupted frames
+    are skipped."""
+
+    def __init__(self, size=256):
+        self.buf = bytearray(size)
+        self.start = self.end = 0
+
+    def feed(self, data):
+        buf, n = self.buf, len(data)
+        if self.end + n > len(buf):
+            # move the unparsed data to the start of the buffer
+            m = self.end - self.start
+            buf[0:m] = buf[self.start:self.end]
+            self.start, self.end = 0, m
+            if m + n > len(buf):
+                self.end = 0
+                data = data[-len(buf):]
+                n = len(data)
+        buf[self.end:self.end + n] = data
+        self.end += n
+
+        frames = []
+        start, end = self.start, self.end
+        while True:
+            start = buf.find(chr(SYNC), start, end)
+            if start < 0:
+                start = end
+                break
+            if end - start < 2:
+                break
+            length = buf[start + 1]
+            if length > MAX_PAYLOAD:
+                # not a frame start: don't wait for the bogus length
+                start += 1
+                continue
+            if end - start < length + 4:
+                break
+            if crc8(buf, start + 1, start + length + 3) != \
+                    buf[start + length + 3]:
+                start += 1
+                continue
+            frames.append(str(buf[start + 2:start + length + 3]))
+            start += length + 4
+
+        self.start = start
+        if start == end:
+            self.start = self.end = 0
+        return frames
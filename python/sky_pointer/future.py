@@ -0,0 +1,134 @@
+import threading
+
+
+class TimeoutError(IOError):
+    pass
+
+
+class CancelledError(Exception):
+    pass
+
+
+class Future(object):
+    """The result of an operation that will be completed later (a serial
+    command, a goto...). It can be waited for from any thread, or completed
+    with a callback."""
+
+    def __init__(self):
+        self.__done = threading.Event()
+        self.__lock = threading.Lock()
+        self.__callbacks = []
+        self.__result = None
+        self.__exception = None
+        self.__cancelled = False
+
+    def done(self):
+        return self.__done.is_set()
+
+    def cancelled(self):
+        return self.__cancelled
+
+    def result(self, timeout=None):
+        """Wait until the future is done and return its result. Raises the
+        exception of the operation if it failed"""
+        if not self.__done.wait(timeout):
+            raise TimeoutError("Timeout waiting for result")
+        if self.__cancelled:
+            raise CancelledError()
+        if self.__exception is not None:
+            raise self.__exception
+        return self.__result
+
+    def exception(self, timeout=None):
+        if not self.__done.wait(timeout):
+            raise TimeoutError("Timeout waiting for result")
+        return self.__exception
+
+    def add_done_callback(self, func):
+        """Call func(future) when the future is done (inmediately, if it is
+        already done)"""
+        with self.__lock:
+            if not self.__done.is_set():
+                self.__callbacks.append(func)
+                return
+        func(self)
+
+    def then(self, func):
+        """Return a new future resolved with func(result) when this one is
+        done. If func returns a future, the new one is resolved with its
+        result. Exceptions (including those raised by func) are propagated."""
+        future = Future()
+
+        def callback(f):
+            if f.cancelled():
+                future.cancel()
+            elif f.exception() is not None:
+                future.set_exception(f.exception())
+            else:
+                try:
+                    result = func(f.result())
+                except Exception as e:
+                    future.set_exception(e)
+                    return
+                if isinstance(result, Future):
+                    result.add_done_callback(future.copy_from)
+                else:
+                    future.set_result(result)
+        self.add_done_callback(callback)
+        return future
+
+    def copy_from(self, other):
+        """Complete this future with the outcome of another (done) one"""
+        if other.cancelled():
+            return self.cancel()
+        elif other.exception() is not None:
+            return self.set_exception(other.exception())
+        return self.set_result(other.result())
+
+    def __complete(self, result=None, exception=None, cancelled=False):
+        with self.__lock:
+            if self.__done.is_set():
+                return False
+            self.__result = result
+            self.__exception = exception
+            self.__cancelled = cancelled
+            self.__done.set()
+            callbacks, self.__callbacks = self.__callbacks, []
+        for func in callbacks:
+            func(self)
+        return True
+
+    def set_result(self, result):
+        return self.__complete(result=result)
+
+    def set_exception(self, exception):
+        return self.__complete(exception=exception)
+
+    def cancel(self):
+        return self.__complete(cancelled=True)
+
+
+def gather(futures):
+    """Return a Future of the list of results of several futures. It fails
+    as soon as any of them fails."""
+    futures = list(futures)
+    result = Future()
+    results = [None]*len(futures)
+    remaining = [len(futures)]
+
+    def callback(i, f):
+        if f.cancelled():
+            result.cancel()
+        elif f.exception() is not None:
+            result.set_exception(f.exception())
+        else:
+            results[i] = f.result()
+            remaining[0] -= 1
+            if not remaining[0]:
+                result.set_result(results)
+
+    if not futures:
+        result.set_result(results)
+    for i, f in enumerate(futures):
+        f.add_done_callback(lambda f, i=i: callback(i, f))
+    return result
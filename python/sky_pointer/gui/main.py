@@ -1,3 +1,4 @@
+import os
 import sys
 import glob
 import serial
@@ -9,11 +10,14 @@ from serial import SerialException
 from sky_pointer.pointer import Pointer
 from sky_pointer.coords import Coords, EqCoords
 from sky_pointer.server import StellariumServerThread
+from sky_pointer.alignment import load_snapshot
 from bright_stars import bright_stars
 import main_dlg
 import calib_dlg
 import goto_dlg
 
+ALIGNMENT_FILE = os.path.expanduser('~/.skypointer_alignment.json')
+
 
 def list_serial_ports():
     """Lists serial port names"""
@@ -171,9 +175,10 @@ class MyApp(QtGui.QDialog, main_dlg.Ui_spcontroller):
             QtGui.QMessageBox.warning(self, "Serial error", str(e))
             self.ptr = None
         else:
-            self.statusDevice.setText(self.ptr.get_id())
+            self.statusDevice.setText(self.ptr.hid)
+            self.load_alignment()
             self.update_calib()
-            #self.load_alignment()
+            self.ptr.autosave_alignment(ALIGNMENT_FILE)
 
         self.calibrateButton.setEnabled(True)
         self.coordBox.setEnabled(self.ptr is not None)
@@ -181,31 +186,26 @@ class MyApp(QtGui.QDialog, main_dlg.Ui_spcontroller):
 
     @requires_pointer
     def load_alignment(self):
-        """load last stored alignment. It doesn't work, because the motors do
-        not maintain its position after shut down.
-        """
-
-        def load(key):
-            val, ok = self.cfg.value(key).toDouble()
-            if not ok:
-                raise ValueError
-            return val
+        """Restore the last alignment snapshot (saved automatically every time
+        the alignment changes). The pointer goes to its first reference star
+        when the homing ends, and the alignment is used only after the star
+        is centered and the Align button is pressed (see onAlign)."""
+        if not os.path.exists(ALIGNMENT_FILE):
+            return
 
         try:
-            eq1 = EqCoords(load('ref1_ra'), load('ref1_dec'))
-            ins1 = Coords(load('ref1_az'), load('ref1_el'))
-            print eq1, ins1
-            self.ptr.set_ref(eq1, ins1, load('ref1_t'))
-
-            eq2 = EqCoords(load('ref2_ra'), load('ref2_dec'))
-            ins2 = Coords(load('ref2_az'), load('ref2_el'))
-            print eq2, ins2
-            self.ptr.set_ref(eq2, ins2, load('ref2_t'))
+            snapshot = load_snapshot(ALIGNMENT_FILE)
+            check = EqCoords(*snapshot['model']['refs'][0][1:3])
+            self.ptr.load_alignment(ALIGNMENT_FILE, check)
+        except (IOError, ValueError, KeyError, IndexError) as e:
+            print "Cannot restore the last alignment:", e
+            return
 
-            print "Restored last alignment"
-            self.statusAligned.setText('Yes (last)')
-        except ValueError as e:
-            print e
+        print "Going to the check star of the last alignment: center it " \
+            "and press Align"
+        self.coordTarget.setText(str(check))
+        self.statusAligned.setText('Check star')
+        self.alignButton.setEnabled(True)
 
 
     def start_server(self):
@@ -328,6 +328,21 @@ class MyApp(QtGui.QDialog, main_dlg.Ui_spcontroller):
 
     @requires_pointer
     def onAlign(self, _):
+        if self.ptr.is_checking_alignment():
+            try:
+                error = self.ptr.accept_alignment()
+            except (ValueError, IOError) as e:
+                QtGui.QMessageBox.warning(self, "Alignment error",
+                                          "The last alignment is not valid: "
+                                          "%s" % e)
+                self.statusAligned.setText('No')
+                return
+            print "Restored last alignment (error: %.4f rad)" % error
+            self.statusAligned.setText('Yes (last)')
+            self.newPointButton.setEnabled(True)
+            self.update_calib()
+            return
+
         try:
             self.ptr.set_ref()
         except ValueError as e:
@@ -355,7 +370,7 @@ class MyApp(QtGui.QDialog, main_dlg.Ui_spcontroller):
     @requires_pointer
     def onNewPoint(self, _):
         tgt = self.ptr.target
-        inst = self.ptr.get_inst_coords()
+        inst = self.ptr.get_inst_coords(exact=True)
         line = "%.2f %.4f %.4f %.4f %.4f" % \
             (time(), tgt[0], tgt[1], inst[0], inst[1])
         self.textPoints.append(line)
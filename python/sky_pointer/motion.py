@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""Host-side motion planning. A slew is planned along the great circle
+joining the start and end directions of the instrument, with a trapezoidal
+speed profile (limited acceleration and speed), and sampled as a list of
+waypoints that are streamed to the board as goto commands. Both axes reach
+every waypoint at the same time, so the laser moves in a straight line on the
+sky instead of following the independent moves of the motors."""
+
+import time
+import logging
+import threading
+import numpy as np
+from math import sqrt, pi
+from protocol import STEPS
+from position import SPEED
+from future import Future
+from pointing_model import eq_cosines, cosines_to_coords
+
+VMAX = .8*pi        # Default max. angular speed along the path (rad/s)
+ACCEL = 2*pi        # Default angular acceleration (rad/s^2)
+PERIOD = .05        # Default time (s) between waypoints
+MAX_SLOWDOWN = 4.   # Max. factor a profile is slowed down by
+LATENCY = .005      # Initial estimation of the command latency (s)
+
+
+class TrapezoidalProfile(object):
+    """Distance travelled along a path of the given length, accelerating at
+    accel up to vmax, cruising, and decelerating to stop at the end"""
+
+    def __init__(self, distance, vmax=VMAX, accel=ACCEL):
+        self.distance = distance
+        self.accel = accel
+        t_acc = vmax/accel
+        if accel*t_acc*t_acc > distance:
+            # triangular profile: vmax is never reached
+            t_acc = sqrt(distance/accel)
+            vmax = accel*t_acc
+        self.vmax = vmax
+        self.t_acc = t_acc
+        self.t_cruise = (distance - accel*t_acc*t_acc)/vmax if vmax else 0.
+        self.duration = 2*t_acc + self.t_cruise
+
+    def position(self, t):
+        """Distance travelled at time(s) t"""
+        t = np.clip(np.asarray(t, dtype=float), 0, self.duration)
+        a, ta, tc = self.accel, self.t_acc, self.t_cruise
+        td = t - ta - tc    # time since the deceleration started
+        return np.where(t < ta, .5*a*t*t,
+                        np.where(td < 0, .5*a*ta*ta + self.vmax*(t - ta),
+                                 self.distance - .5*a*(ta - td)**2))
+
+
+def great_circle(u, v):
+    """Return the unit vector w orthogonal to u in the plane of u and v, and
+    the angle between u and v. The great circle is u*cos(a) + w*sin(a). If u
+    and v are opposite, the circle goes through the pole of the mount."""
+    cos_angle = np.clip(np.dot(u, v), -1., 1.)
+    w = v - u*cos_angle
+    norm = np.linalg.norm(w)
+    if norm < 1e-9:
+        w = np.array([0., 0., 1.]) - u*u[2]
+        if np.linalg.norm(w) < 1e-9:
+            w = np.array([1., 0., 0.]) - u*u[0]
+        norm = np.linalg.norm(w)
+    return w/norm, np.arccos(cos_angle)
+
+
+class MotionPlanner(object):
+    """Planner of straight (great circle) slews with synchronized axes.
+
+    vmax: max. angular speed along the path (rad/s)
+    accel: angular acceleration (rad/s^2)
+    axis_speed: max. speed of every axis (rad/s). The profile is slowed down
+    if any axis would need to move faster (near the pole of the mount), at
+    most by MAX_SLOWDOWN (the azimuth cannot follow a path crossing the
+    pole, but there the pointing error is small)
+    period: time (s) between waypoints
+    """
+
+    def __init__(self, vmax=VMAX, accel=ACCEL, axis_speed=SPEED*2*pi/STEPS,
+                 period=PERIOD):
+        self.vmax = vmax
+        self.accel = accel
+        self.axis_speed = axis_speed
+        self.period = period
+
+    def plan(self, start, end):
+        """Plan a slew between two instrumental coordinates (radians).
+        Returns an Nx3 array of waypoints (t, x, y), with t relative to the
+        start of the movement. The elevations are normalized to
+        [-pi/2, pi/2]."""
+        u, v = eq_cosines([start, end]).T
+        w, angle = great_circle(u, v)
+
+        vmax, accel = self.vmax, self.accel
+        slowdown = 1.
+        while True:
+            profile = TrapezoidalProfile(angle, vmax, accel)
+            n = max(int(np.ceil(profile.duration/self.period)), 1)
+            t = np.linspace(0, profile.duration, n + 1)
+            a = profile.position(t)
+            coords = cosines_to_coords(np.outer(u, np.cos(a)) +
+                                       np.outer(w, np.sin(a)))
+
+            # fastest axis movement between waypoints
+            d = np.abs(np.diff(coords, axis=0))
+            d = np.minimum(d, 2*pi - d)
+            dt = np.diff(t)[:, None]
+            factor = (d/np.where(dt > 0, dt, 1)).max()/self.axis_speed \
+                if n > 1 else 0
+            factor = min(factor, MAX_SLOWDOWN/slowdown)
+            if factor <= 1.01:
+                break
+            slowdown *= factor
+            vmax, accel = vmax/factor, accel/factor**2
+
+        coords[-1] = cosines_to_coords(v[:, None])[0]
+        return np.column_stack((t, coords))
+
+
+class WaypointStreamer(object):
+    """Sends a list of waypoints at their times from a thread. Every command
+    is sent in advance by the estimated latency (the average of half the
+    round trip time of the previous commands), so the board receives it on
+    time.
+
+    send: function called with the index of a waypoint, which must send it
+    and return the Future of the command
+    times: time of every waypoint, relative to the start
+    """
+
+    def __init__(self, send, times, latency=LATENCY):
+        self.send = send
+        self.times = times
+        self.latency = latency
+        self.future = Future()
+        self.__cancel = threading.Event()
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def cancel(self):
+        """Stop sending waypoints. When it returns, no more waypoints will be
+        sent"""
+        self.__cancel.set()
+        with self.__lock:
+            pass
+
+    def __measure(self, future, sent):
+        if future.exception() is None:
+            self.latency += .2*((time.time() - sent)/2 - self.latency)
+
+    def run(self):
+        """Send the waypoints. The future is completed with the index of the
+        last waypoint sent"""
+        t0 = time.time()
+        i = -1
+        try:
+            for i, t in enumerate(self.times):
+                delay = t0 + t - self.latency - time.time()
+                if delay > 0:
+                    self.__cancel.wait(delay)
+                with self.__lock:
+                    if self.__cancel.is_set():
+                        i -= 1
+                        break
+                    sent = time.time()
+                    future = self.send(i)
+                future.add_done_callback(
+                    lambda f, sent=sent: self.__measure(f, sent))
+        except (IOError, ValueError) as e:
+            logging.error("Waypoint %d: %s" % (i, e))
+            self.future.set_exception(e)
+            return
+        self.future.set_result(i)
+
+
+if __name__ == '__main__':
+    planner = MotionPlanner()
+    start, end = (0., .2), (2., 1.)
+    wps = planner.plan(start, end)
+    print "%d waypoints in %.2f s" % (len(wps), wps[-1, 0])
+
+    # all the waypoints lie on the great circle (same plane through the
+    # origin as the start and end directions)
+    u, v = eq_cosines([start, end]).T
+    normal = np.cross(u, v)
+    assert np.abs(np.dot(normal, eq_cosines(wps[:, 1:]))).max() < 1e-12
+    assert np.allclose(wps[0, 1:], start) and np.allclose(wps[-1, 1:], end)
+
+    # the axes never exceed their max. speed
+    d = np.abs(np.diff(wps[:, 1:], axis=0))
+    d = np.minimum(d, 2*pi - d)/np.diff(wps[:, 0])[:, None]
+    print "Max. axis speed: %.3f rad/s" % d.max()
+    assert d.max() <= planner.axis_speed*1.02
+
+    # near the pole the slew is slowed down
+    wps = planner.plan((0., 1.5), (pi, 1.5))
+    print "Through the pole: %d waypoints in %.2f s" % (len(wps), wps[-1, 0])
@@ -1,42 +1,205 @@
+import time
+import logging
+import threading
+import numpy as np
 from math import pi
 from pointing_model import PointingModel
-from protocol import Protocol, STEPS
+from protocol import Protocol, AsyncProtocol, STEPS
 from coords import Coords, EqCoords
+from future import Future, CancelledError, gather
+from position import PositionEstimator
+from motion import MotionPlanner, WaypointStreamer
+from alignment import save_snapshot, load_snapshot, angular_distance
 
 
+# Conversion between motor positions and angles. Positions are taken modulo
+# STEPS, and position 0 is angle 0. Angles are returned in (-pi, pi]
+# (positions up to STEPS/2 are positive), and positions in [0, STEPS).
+
 def _steps2rad(steps):
+    if isinstance(steps, (int, long)):
+        return _STEP_ANGLES[steps % STEPS]
     p = 2.*(steps % STEPS)/STEPS
     return pi*(p if p <= 1 else p-2)
 
-def _rad2steps(angle):
-    a = (angle/2.) % pi
-    return STEPS*(a if a <= pi else pi-a)/pi
+# angle of every integer position
+_STEP_ANGLES = [_steps2rad(float(i)) for i in range(STEPS)]
+STEP_ANGLES = np.array(_STEP_ANGLES)
+
+def _rad2steps(angle, exact=False):
+    s = (angle % (2*pi))*(STEPS/(2*pi))
+    if exact:
+        return int(round(s)) % STEPS
+    # a tiny negative angle is rounded to 2*pi
+    return s if s < STEPS else 0.
 
 def steps2rad(a, b):
     return _steps2rad(a), _steps2rad(b)
 
-def rad2steps(a, b):
-    return _rad2steps(a), _rad2steps(b)
+def rad2steps(a, b, exact=False):
+    """Motor positions of a pair of angles. If exact is True, they are
+    rounded to the nearest integer position"""
+    return _rad2steps(a, exact), _rad2steps(b, exact)
+
+def steps2rad_array(steps):
+    """Angles of an array of motor positions. Integer positions are
+    converted with a lookup table"""
+    steps = np.asarray(steps)
+    if steps.dtype.kind in 'iu':
+        return STEP_ANGLES[steps % STEPS]
+    p = 2.*(steps % STEPS)/STEPS
+    return pi*np.where(p <= 1, p, p - 2)
+
+def rad2steps_array(angles, exact=False):
+    """Motor positions of an array of angles. If exact is True, they are
+    rounded to the nearest integer position"""
+    s = np.mod(angles, 2*pi)*(STEPS/(2*pi))
+    if exact:
+        return np.rint(s).astype(int) % STEPS
+    return np.where(s < STEPS, s, 0.)
+
+
+TRACK_MIN_PERIOD = .2   # Min. time (s) between tracking corrections
+TRACK_MAX_PERIOD = 30.  # Max. time (s) between tracking updates
+HOME_TIMEOUT = 60.      # Max. time (s) waiting for the homing when opening
+HOME_POS = (0, 0)       # Motor positions of the home position
+CHECK_TOLERANCE = .005  # Max. error (rad) of a restored alignment
+
+
+def _track_step(target, t):
+    """Rounded motor positions of a tracked target at time t, and the time
+    until the rounded position of any axis changes"""
+    steps = rad2steps(*target.at(t))
+    later = rad2steps(*target.at(t + 1.))
+    rates = [(b - a + STEPS/2) % STEPS - STEPS/2
+             for a, b in zip(steps, later)]
+
+    period = TRACK_MAX_PERIOD
+    for x, rate in zip(steps, rates):
+        if rate:
+            edge = round(x) + (.5 if rate > 0 else -.5)
+            period = min(period, (edge - x)/rate)
+    pos = tuple(int(round(x)) % STEPS for x in steps)
+    return pos, max(period, TRACK_MIN_PERIOD)
+
+
+class Tracker(threading.Thread):
+    """Keeps pointing to a fixed object while the Earth rotates. The motor
+    positions are computed only when the target is expected to have moved
+    by one microstep, so the update rate follows the angular speed of the
+    target (slow near the celestial pole), and a goto is sent only if the
+    rounded positions have changed.
+
+    target: TrackedTarget
+    send: function called with the new motor positions
+    arrival: Future of the initial goto. Tracking starts when it is done
+    """
+
+    def __init__(self, target, send, arrival=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.target = target
+        self.send = send
+        self.arrival = arrival
+        self.lock = threading.Lock()
+        self.updates = 0
+        self.__stop = threading.Event()
+        self.__wake = threading.Event()
+
+    def stop(self):
+        """Stop tracking. When it returns, no more gotos will be sent"""
+        self.__stop.set()
+        self.__wake.set()
+        with self.lock:
+            pass
+
+    def run(self):
+        if self.arrival:
+            self.arrival.add_done_callback(lambda f: self.__wake.set())
+            self.__wake.wait()
+            if self.arrival.cancelled():
+                return
+        last = None
+        while not self.__stop.is_set():
+            pos, delay = _track_step(self.target, time.time())
+            with self.lock:
+                if self.__stop.is_set():
+                    break
+                if pos != last:
+                    self.send(*pos)
+                    self.updates += 1
+                    last = pos
+            self.__stop.wait(delay + .001)
+
+
+class AsyncTracker(object):
+    """Tracker driven by an EventLoop: the updates are scheduled with
+    call_later instead of running in a thread"""
+
+    def __init__(self, loop, target, send, arrival=None):
+        self.loop = loop
+        self.target = target
+        self.send = send
+        self.updates = 0
+        self.__last = None
+        self.__handle = None
+        self.__stopped = False
+        if arrival:
+            arrival.add_done_callback(self.__arrived)
+        else:
+            self.__update()
+
+    def __arrived(self, arrival):
+        if not arrival.cancelled():
+            self.__update()
+
+    def __update(self):
+        if self.__stopped:
+            return
+        pos, delay = _track_step(self.target, time.time())
+        if pos != self.__last:
+            self.send(*pos)
+            self.updates += 1
+            self.__last = pos
+        self.__handle = self.loop.call_later(delay + .001, self.__update)
+
+    def stop(self):
+        self.__stopped = True
+        if self.__handle:
+            self.__handle.cancel()
 
 
 class Pointer:
-    def __init__(self, device='/dev/ttyUSB0', baud=115200):
-        self.__hw = Protocol(device, baud)
+    def __init__(self, device='/dev/ttyUSB0', baud=115200, nstar=False,
+                 binary=False):
+        self.__hw = Protocol(device, baud, binary)
         self.hid = self.get_id()
         self.calib = self.__get_calib()
         self.__pm = PointingModel(z1=self.calib[0], z2=self.calib[1],
-                                  z3=self.calib[2])
+                                  z3=self.calib[2], nstar=nstar)
         self.target = EqCoords(0, 0)
-        self.home()
+        self.position = PositionEstimator(self.__hw)
+        self.planner = MotionPlanner()
+        self.__stream = None
+        self.__tracker = None
+        self.__snapshot_file = None
+        self.__candidate = None     # restored alignment not verified yet
+        # motor positions after the homing done when opening, which are the
+        # reference of the alignment snapshots
+        self.__home_pos = Future()
+        self.home().add_done_callback(self.__homed)
 
     def get_id(self):
         return self.__hw.get_id()
 
     def home(self):
-        return self.__hw.home()
+        """Go to the home position. Returns a Future completed on arrival"""
+        self.__cancel_motion()
+        self.__hw.home()
+        return self.position.home()
 
     def __get_calib(self):
-        return [self.__hw.get_calib(i) for i in range(3)]
+        return self.__hw.get_calibs(3)
 
     def set_calib(self, calib):
         if len(calib) != 3:
@@ -46,7 +209,109 @@ class Pointer:
             self.__hw.set_calib(i, v)
 
     def set_ref(self, eq=None, inst=None, t=0):
-        self.__pm.set_ref(eq or self.target, inst or self.get_inst_coords(), t)
+        self.__pm.set_ref(eq or self.target,
+                         inst or self.get_inst_coords(exact=True), t)
+        self.__autosave()
+
+    def __homed(self, arrival):
+        # if another command interrupts the homing, the reference is the
+        # commanded home position
+        if arrival.cancelled() or arrival.exception() is not None:
+            self.__home_pos.set_result(HOME_POS)
+        else:
+            self.__home_pos.set_result(arrival.result())
+
+    def home_pos(self):
+        """Motor positions reached by the homing done when opening the
+        pointer. Waits for the arrival"""
+        return self.__home_pos.result(HOME_TIMEOUT)
+
+    def save_alignment(self, path):
+        """Save an alignment snapshot, with the homed motor positions"""
+        save_snapshot(path, self.__pm.get_state(), self.calib,
+                      self.home_pos(), self.hid)
+
+    def load_alignment(self, path, check):
+        """Restore an alignment snapshot after homing. The motors lose their
+        position on shutdown, so the model is referred to the homed
+        positions saved in the snapshot.
+        The restored model is not used until it is verified: the pointer
+        goes to the check star (equatorial coordinates) with it, and once
+        the star has been centered manually, accept_alignment activates it.
+        Returns the Future of the arrival to the check star."""
+        snapshot = load_snapshot(path)
+        state = snapshot['model']
+
+        def homed(home):
+            offset = [(a - b) % STEPS
+                      for a, b in zip(home, snapshot['steps'])]
+            if not any(offset):
+                pm = PointingModel.from_state(state)
+            else:
+                # move the instrumental coords of the references
+                da, db = steps2rad(*offset)
+                pm = PointingModel(state['t0'], *state['z'],
+                                   nstar=state['nstar'])
+                for t, ra, dec, a, b in state['refs']:
+                    pm.set_ref(EqCoords(ra, dec), Coords(a + da, b + db), t)
+
+            self.__candidate = pm, snapshot['calib']
+            self.target = check
+            steps = rad2steps(*pm.eq_to_inst_fast(check), exact=True)
+            self.__cancel_motion()
+            self.__hw.goto(*steps)
+            return self.position.goto(*steps)
+
+        return self.__home_pos.then(homed)
+
+    def is_checking_alignment(self):
+        return self.__candidate is not None
+
+    def accept_alignment(self, tolerance=CHECK_TOLERANCE):
+        """Verify the restored alignment with the check star, which must have
+        been centered manually. If the error is within tolerance (rad), the
+        restored model and calibration are activated. Otherwise, a
+        ValueError is raised and the previous alignment is kept. Returns the
+        error"""
+        if self.__candidate is None:
+            raise ValueError("There is no alignment to verify")
+        pm, calib = self.__candidate
+        self.__candidate = None
+        error = self.alignment_error(pm=pm)
+        if error > tolerance:
+            raise ValueError("Wrong alignment (error: %.4f rad)" % error)
+
+        if list(calib) != list(self.calib):
+            self.set_calib(calib)
+            self.calib = calib
+        self.__pm = pm
+        self.__autosave()
+        return error
+
+    def discard_alignment(self):
+        self.__candidate = None
+
+    def alignment_error(self, eq=None, pm=None):
+        """Angle (rad) between the given equatorial coordinates (by default,
+        the target) and the current pointing direction, given by the model
+        pm (by default, the current one). It measures the error of an
+        alignment after centering a star manually"""
+        inst = steps2rad(*self.get_motor_pos())
+        return angular_distance(eq or self.target,
+                                (pm or self.__pm).inst_to_eq_fast(inst))
+
+    def autosave_alignment(self, path):
+        """Save an alignment snapshot every time the alignment changes, so
+        it can be restored after a restart"""
+        self.__snapshot_file = path
+        self.__autosave()
+
+    def __autosave(self):
+        if self.__snapshot_file and self.__pm.get_nrefs() > 1:
+            try:
+                self.save_alignment(self.__snapshot_file)
+            except (IOError, OSError, CancelledError) as e:
+                logging.error("Cannot save the alignment: %s" % e)
 
     def get_refs(self):
         """Return a list of dictionaries, each containing the observation time,
@@ -61,7 +326,9 @@ class Pointer:
         return refs
 
     def steps(self, ha, el):
+        self.__cancel_motion()
         self.__hw.move(ha, el)
+        return self.position.move(ha, el)
 
     def run(self, ha_dir, el_dir):
         if not -1 <= ha_dir <= 1:
@@ -69,26 +336,313 @@ class Pointer:
         if not -1 <= el_dir <= 1:
             raise ValueError("el_dir must be between -1 and 1")
         half = STEPS/2 - 1
-        self.__hw.move(ha_dir*half, el_dir*half)
+        return self.steps(ha_dir*half, el_dir*half)
 
     def stop(self):
+        self.__cancel_motion()
         self.__hw.stop()
+        self.position.stop()
 
     def enable_laser(self, enable):
         self.__hw.enable_laser(enable)
 
-    def get_coords(self):
-        return self.__pm.inst_to_eq(steps2rad(*self.__hw.get_pos()))
+    def __motor_pos(self, exact):
+        if exact:
+            return self.__hw.get_pos()
+        self.position.get_pos()
+        return self.position.predict()
 
-    def get_inst_coords(self):
-        return Coords(*steps2rad(*self.__hw.get_pos()))
+    def get_coords(self, exact=False):
+        """Current equatorial coordinates. Unless exact is True, they are
+        estimated from the last commands instead of read from the board."""
+        return self.__pm.inst_to_eq_fast(steps2rad(*self.__motor_pos(exact)))
+
+    def get_inst_coords(self, exact=False):
+        return Coords(*steps2rad(*self.__motor_pos(exact)))
 
     def get_motor_pos(self):
         return self.__hw.get_pos()
 
+    def get_steps(self, eq):
+        """Motor positions (microsteps) corresponding to the given equatorial
+        coordinates"""
+        return rad2steps(*self.__pm.eq_to_inst_fast(eq), exact=True)
+
     def goto(self, eq):
+        """Point to the given equatorial coordinates. Returns a Future
+        completed (with the motor positions) when the target is reached"""
+        self.target = eq
+        steps = self.get_steps(eq)
+        tracking = self.__tracker is not None
+        self.__cancel_motion()
+        self.__hw.goto(*steps)
+        arrival = self.position.goto(*steps)
+        if tracking:
+            self.__start_tracking(eq, arrival)
+        return arrival
+
+    def track(self, eq=None):
+        """Go to the given equatorial coordinates (by default, the current
+        target) and keep pointing to them, until another movement is
+        commanded. A goto changes the tracked target. Returns the Future of
+        the arrival"""
+        self.stop_tracking()
+        arrival = self.goto(eq or self.target)
+        self.__start_tracking(self.target, arrival)
+        return arrival
+
+    def __start_tracking(self, eq, arrival):
+        def send(ha, el):
+            self.__hw.goto(ha, el, wait=False)
+            self.position.follow(ha, el)
+
+        self.__tracker = Tracker(self.__pm.track(eq), send, arrival)
+        self.__tracker.start()
+
+    def is_tracking(self):
+        return self.__tracker is not None
+
+    def stop_tracking(self):
+        if self.__tracker:
+            self.__tracker.stop()
+            self.__tracker = None
+
+    def slew(self, eq):
+        """Point to the given equatorial coordinates moving along a straight
+        line on the sky (see the motion module). Returns a Future completed
+        when the target is reached"""
+        end = self.__pm.eq_to_inst_fast(eq)
+        start = steps2rad(*self.position.predict())
+        waypoints = self.planner.plan(start, end)
+        steps = rad2steps_array(waypoints[:, 1:], exact=True).tolist()
+        steps[-1] = rad2steps(*end, exact=True)
         self.target = eq
-        self.__hw.goto(*rad2steps(*self.__pm.eq_to_inst(eq)))
+        arrival = Future()
+
+        def send(i):
+            future = self.__hw.goto(*steps[i], wait=False)
+            if i < len(steps) - 1:
+                self.position.follow(*steps[i])
+            else:
+                self.position.goto(*steps[i]).add_done_callback(
+                    arrival.copy_from)
+            return future
+
+        def streamed(f):
+            if f.exception() is not None:
+                arrival.set_exception(f.exception())
+            elif f.result() < len(steps) - 1:
+                arrival.cancel()
+
+        self.__cancel_motion()
+        self.__stream = WaypointStreamer(send, waypoints[:, 0])
+        self.__stream.future.add_done_callback(streamed)
+        self.__stream.start()
+        return arrival
+
+    def __cancel_motion(self):
+        """Stop the streamed slews and the tracking"""
+        self.stop_tracking()
+        if self.__stream:
+            self.__stream.cancel()
+            self.__stream = None
 
     def close(self):
+        self.__cancel_motion()
+        self.position.close()
         self.__hw.close()
+
+
+class AsyncPointer:
+    """Pointer driven by an EventLoop. The methods return a Future instead of
+    blocking. open() must be called (and its future waited for) before using
+    the pointer."""
+
+    def __init__(self, loop, device='/dev/ttyUSB0', baud=115200, nstar=False):
+        self.loop = loop
+        self.__hw = AsyncProtocol(loop, device, baud)
+        self.position = PositionEstimator(self.__hw,
+                                          call_later=loop.call_later)
+        self.__nstar = nstar
+        self.__pm = None
+        self.hid = None
+        self.calib = None
+        self.target = EqCoords(0, 0)
+        self.__tracker = None
+
+    def open(self, binary=False):
+        """Wait for the board, read the calibration and start going home"""
+        def synced(pos):
+            self.home()
+
+        def calibrated(calib):
+            self.calib = calib
+            self.__pm = PointingModel(z1=calib[0], z2=calib[1], z3=calib[2],
+                                      nstar=self.__nstar)
+            return self.position.sync().then(synced)
+
+        def connected(hid):
+            self.hid = hid
+            return self.__hw.get_calibs(3).then(calibrated)
+
+        return self.__hw.connect(binary).then(connected)
+
+    def get_id(self):
+        return self.__hw.get_id()
+
+    def home(self):
+        self.stop_tracking()
+        return self.__sent(self.__hw.home(), self.position.home())
+
+    def __sent(self, command, arrival):
+        """Future of the arrival, failed if the command fails"""
+        return command.then(lambda ret: arrival)
+
+    def set_calib(self, calib):
+        if len(calib) != 3:
+            raise ValueError("Wrong number of calibration values")
+        return gather([self.__hw.set_calib(i, v) for i, v in enumerate(calib)])
+
+    def set_ref(self, eq=None, inst=None, t=0):
+        eq = eq or self.target
+        pos = Future()
+        if inst:
+            pos.set_result(inst)
+        else:
+            pos = self.get_inst_coords(exact=True)
+        return pos.then(lambda inst: self.__pm.set_ref(eq, inst, t))
+
+    def get_refs(self):
+        """Return a list of dictionaries, each containing the observation time,
+        equatorial and instrumental coordinates of a reference star"""
+        refs = []
+        for i in range(self.__pm.get_nrefs()):
+            refs.append({'eq': self.__pm.eq_refs[i],
+                         'inst': self.__pm.inst_refs[i],
+                         't': self.__pm.t_refs[i]})
+        return refs
+
+    def steps(self, ha, el):
+        self.stop_tracking()
+        return self.__sent(self.__hw.move(ha, el),
+                           self.position.move(ha, el))
+
+    def run(self, ha_dir, el_dir):
+        if not -1 <= ha_dir <= 1:
+            raise ValueError("ha_dir must be between -1 and 1")
+        if not -1 <= el_dir <= 1:
+            raise ValueError("el_dir must be between -1 and 1")
+        half = STEPS/2 - 1
+        return self.steps(ha_dir*half, el_dir*half)
+
+    def stop(self):
+        self.stop_tracking()
+        ret = self.__hw.stop()
+        self.position.stop()
+        return ret
+
+    def enable_laser(self, enable):
+        return self.__hw.enable_laser(enable)
+
+    def get_steps(self, eq):
+        return rad2steps(*self.__pm.eq_to_inst_fast(eq), exact=True)
+
+    def __motor_pos(self, exact):
+        if exact:
+            return self.__hw.get_pos()
+        self.position.get_pos()
+        pos = Future()
+        pos.set_result(self.position.predict())
+        return pos
+
+    def get_coords(self, exact=False):
+        """Future of the current equatorial coordinates. Unless exact is
+        True, they are estimated from the last commands instead of read from
+        the board."""
+        return self.__motor_pos(exact).then(
+            lambda pos: self.__pm.inst_to_eq_fast(steps2rad(*pos)))
+
+    def get_inst_coords(self, exact=False):
+        return self.__motor_pos(exact).then(
+            lambda pos: Coords(*steps2rad(*pos)))
+
+    def get_motor_pos(self):
+        return self.__hw.get_pos()
+
+    def goto(self, eq):
+        self.target = eq
+        steps = self.get_steps(eq)
+        tracking = self.__tracker is not None
+        self.stop_tracking()
+        arrival = self.__sent(self.__hw.goto(*steps),
+                              self.position.goto(*steps))
+        if tracking:
+            self.__start_tracking(eq, arrival)
+        return arrival
+
+    def track(self, eq=None):
+        """Go to the given equatorial coordinates (by default, the current
+        target) and keep pointing to them, until another movement is
+        commanded. A goto changes the tracked target. Returns the Future of
+        the arrival"""
+        self.stop_tracking()
+        arrival = self.goto(eq or self.target)
+        self.__start_tracking(self.target, arrival)
+        return arrival
+
+    def __start_tracking(self, eq, arrival):
+        def send(ha, el):
+            self.__hw.goto(ha, el)
+            self.position.follow(ha, el)
+
+        self.__tracker = AsyncTracker(self.loop, self.__pm.track(eq), send,
+                                      arrival)
+
+    def is_tracking(self):
+        return self.__tracker is not None
+
+    def stop_tracking(self):
+        if self.__tracker:
+            self.__tracker.stop()
+            self.__tracker = None
+
+    def close(self):
+        self.stop_tracking()
+        self.position.close()
+        return self.__hw.close()
+
+
+if __name__ == '__main__':
+    # round trip checks of the conversions (there is no test suite)
+    rnd = np.random.RandomState(0)
+
+    # every integer position: LUT, formula and round trip are exact
+    k = np.arange(-2*STEPS, 2*STEPS)
+    angles = steps2rad_array(k)
+    assert np.all(angles > -pi) and np.all(angles <= pi)
+    assert np.array_equal(angles, steps2rad_array(k.astype(float)))
+    assert np.array_equal(rad2steps_array(angles, exact=True), k % STEPS)
+    assert all(_steps2rad(int(i)) == a for i, a in zip(k, angles))
+    assert all(_rad2steps(a, True) == i % STEPS for i, a in zip(k, angles))
+
+    # random positions and angles
+    x = rnd.uniform(-10*STEPS, 10*STEPS, 100000)
+    s = rad2steps_array(steps2rad_array(x))
+    d = (s - x) % STEPS
+    assert np.all(np.minimum(d, STEPS - d) < 1e-9)
+    a = rnd.uniform(-20*pi, 20*pi, 100000)
+    s = rad2steps_array(a)
+    assert np.all(s >= 0) and np.all(s < STEPS)
+    d = (steps2rad_array(s) - a) % (2*pi)
+    assert np.all(np.minimum(d, 2*pi - d) < 1e-12)
+    assert all(_rad2steps(v) == w for v, w in zip(a[:1000], s[:1000]))
+
+    # wrap edges
+    assert _rad2steps(-1e-20) == 0 and rad2steps_array([-1e-20])[0] == 0
+    assert _rad2steps(-1e-20, True) == 0 and _rad2steps(pi) == STEPS/2
+    assert _steps2rad(STEPS/2) == pi and _steps2rad(STEPS/2 + 1) < 0
+
+    t = time.time()
+    steps2rad_array(rnd.randint(0, STEPS, 10**6))
+    t = time.time() - t
+    print "Conversion checks passed (10^6 positions in %.3f s)" % t
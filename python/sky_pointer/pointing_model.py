@@ -1,6 +1,6 @@
 import time
 import numpy as np
-from math import sin, cos, atan2, asin, pi
+from math import sin, cos, atan2, asin, sqrt, pi
 from coords import Coords, EqCoords
 
 K = 1.002737908             # solar-to-sidereal time ratio
@@ -17,6 +17,25 @@ def cosine_to_coords(v):
     return atan2(v[1], v[0]), asin(v[2])
 
 
+def eq_cosines(coords):
+    """ Get the direction cosines (3xN array) of a set of objects given their
+    equatorial coords (Nx2 array) """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    a, b = coords[:, 0], coords[:, 1]
+    cb = np.cos(b)
+    return np.vstack((cb*np.cos(a), cb*np.sin(a), np.sin(b)))
+
+
+def cosines_to_coords(v, normalize=True):
+    """ Get the coords (Nx2 array) of a set of direction cosines (3xN array) """
+    if normalize:
+        v = v/np.sqrt((v*v).sum(axis=0))
+    coords = np.empty((v.shape[1], 2))
+    np.arctan2(v[1], v[0], out=coords[:, 0])
+    np.arcsin(np.clip(v[2], -1., 1.), out=coords[:, 1])
+    return coords
+
+
 def orthonormal(u, v):
     """ Obtain a unit vector orthogonal to two given vectors """
     w = np.cross(u.T, v.T)
@@ -27,22 +46,33 @@ def orthonormal(u, v):
 class PointingModel(object):
     """ Implementation of Toshimi Taki's "Equations for Pointing a Telescope":
     http://www.geocities.jp/toshimi_taki/aim/aim.htm
+
+    If nstar is True, any number of reference stars can be added. T is then
+    the rotation that best fits all of them in the least-squares sense
+    (orthogonal Procrustes problem), updated every time a new star is added.
     """
 
-    def __init__(self, t=0, z1=.0, z2=.0, z3=.0):
+    def __init__(self, t=0, z1=.0, z2=.0, z3=.0, nstar=False):
         self.z1, self.z2, self.z3 = z1, z2, z3  # mount errors
         self.t0 = t or time.time()  # reference timestamp
         self.T = np.eye(3)          # transformation matrix
         self.Tinv = np.eye(3)       # inverse of T
-
-        # coords of reference stars (equatorial)
-        self.eq_refs = [EqCoords(0, 0), EqCoords(pi/2, 0)]
-        # coords of reference stars (instrumental)
-        self.inst_refs = [EqCoords(0, 0), EqCoords(pi/2, 0)]
-        # timestamp of observation of reference stars
-        self.t_refs = [0, 0]
+        self.nstar = nstar
+
+        if nstar:
+            self.eq_refs, self.inst_refs, self.t_refs = [], [], []
+            # sum of the outer products of the reference cosines
+            self.__B = np.zeros((3, 3))
+        else:
+            # coords of reference stars (equatorial)
+            self.eq_refs = [EqCoords(0, 0), EqCoords(pi/2, 0)]
+            # coords of reference stars (instrumental)
+            self.inst_refs = [EqCoords(0, 0), EqCoords(pi/2, 0)]
+            # timestamp of observation of reference stars
+            self.t_refs = [0, 0]
         self.__ref_count = 0
         self.__computed = False
+        self.__update_tuples()
 
     def app_to_real_cosine(self, coords):
         """ Calculate the real direction cosine of an object given the apparent
@@ -53,6 +83,18 @@ class PointingModel(object):
                          [cos(b)*sin(a) + z2*cos(a) - z1*sin(b)*cos(a)],
                          [sin(b)]])
 
+    def app_to_real_cosines(self, coords):
+        """ Vectorized version of app_to_real_cosine. Take an Nx2 array of
+        apparent instrumental coordinates and return a 3xN array of real
+        direction cosines """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        a, b = coords[:, 0], coords[:, 1] + self.z3
+        z1, z2 = self.z1, self.z2
+        sa, ca, sb, cb = np.sin(a), np.cos(a), np.sin(b), np.cos(b)
+        return np.vstack((cb*ca - z2*sa + z1*sb*sa,
+                          cb*sa + z2*ca - z1*sb*ca,
+                          sb))
+
     def app_to_real_coords(self, coords):
         """ Calculate the real instrumental coordinates of an object given
         the apparent ones """
@@ -69,6 +111,26 @@ class PointingModel(object):
         c, d =  cosine_to_coords(v2)
         return Coords(c, d - self.z3)
 
+    def real_to_app_array(self, coords):
+        """ Vectorized version of real_to_app_coords (Nx2 arrays) """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        a, b = coords[:, 0], coords[:, 1]
+        z1, z2 = self.z1, self.z2
+        sa, ca, sb, cb = np.sin(a), np.cos(a), np.sin(b), np.cos(b)
+        app = cosines_to_coords(np.vstack((cb*ca + z2*sa - z1*sb*sa,
+                                           cb*sa - z2*ca + z1*sb*ca,
+                                           sb)), normalize=False)
+        app[:, 1] -= self.z3
+        return app
+
+    def __times(self, t, n):
+        """ Broadcast a timestamp (or an array of N timestamps) to an array
+        of elapsed sidereal angles since t0 """
+        t = np.asarray(t, dtype=float)
+        if not t.ndim and not t:
+            t = time.time()
+        return np.broadcast_to(K*SEC2RAD*(t - self.t0), (n,))
+
     def __local_eq(self, eq, t):
         return EqCoords(eq[0] - K*SEC2RAD*(t - self.t0), eq[1])
 
@@ -99,8 +161,40 @@ class PointingModel(object):
         V = np.hstack((v1, v2, v3))
         self.T = U.dot(np.linalg.inv(V))
         self.Tinv = np.linalg.inv(self.T)
+        self.__update_tuples()
         self.__computed = True
 
+    def __update_tuples(self):
+        # flat copies of T and Tinv used by the scalar (pure float) path
+        self.__Tt = tuple(float(x) for x in self.T.flat)
+        self.__Tinvt = tuple(float(x) for x in self.Tinv.flat)
+        self.__sidereal = None, None, None
+
+    def __add_ref_lsq(self, eq, inst, t):
+        """ Add a reference star to the least-squares solution. Only the 3x3
+        matrix B = sum(u*v') is updated, so the cost does not depend on the
+        number of stars """
+        u = self.app_to_real_cosine(inst)
+        v = eq_cosine(self.__local_eq(eq, t))
+        B = self.__B + (u/np.linalg.norm(u)).dot(v.T)
+
+        # the rotation maximizing trace(T'B) is obtained from the SVD of B
+        W, S, Vt = np.linalg.svd(B)
+        if len(self.eq_refs):
+            if S[1] < 1e-9*S[0]:
+                raise ValueError("Invalid reference stars: "
+                                 "Coordinates must be different!")
+            d = np.sign(np.linalg.det(W.dot(Vt)))
+            self.T = W.dot(np.diag([1., 1., d])).dot(Vt)
+            self.Tinv = self.T.T
+            self.__update_tuples()
+            self.__computed = True
+        self.__B = B
+
+        self.t_refs.append(t)
+        self.eq_refs.append(EqCoords(eq[0], eq[1]))
+        self.inst_refs.append(Coords(inst[0], inst[1]))
+
     def _set_ref_n(self, n, eq, inst, t=0):
         self.t_refs[n] = t or time.time()
         self.eq_refs[n] = EqCoords(eq[0], eq[1])
@@ -108,15 +202,51 @@ class PointingModel(object):
 
     def set_ref(self, eq, inst, t=0):
         """ Add a new reference star """
-        self._set_ref_n(self.__ref_count % 2, eq, inst, t)
-        # if there are two reference stars, compute the T matrix
-        if self.__ref_count:
-            self.__compute_matrix()
+        if self.nstar:
+            self.__add_ref_lsq(eq, inst, t or time.time())
+        else:
+            self._set_ref_n(self.__ref_count % 2, eq, inst, t)
+            # if there are two reference stars, compute the T matrix
+            if self.__ref_count:
+                self.__compute_matrix()
         self.__ref_count += 1
 
     def get_nrefs(self):
         return self.__ref_count
 
+    def get_state(self):
+        """ Return the state of the model (mount errors, reference stars and
+        transformation matrix) as a dictionary of plain Python types """
+        refs = zip(self.t_refs, self.eq_refs, self.inst_refs)
+        return {'t0': self.t0,
+                'z': [self.z1, self.z2, self.z3],
+                'nstar': self.nstar,
+                'refs': [[t, eq[0], eq[1], inst[0], inst[1]]
+                         for t, eq, inst in refs],
+                'ref_count': self.__ref_count,
+                'computed': self.__computed,
+                'T': self.T.tolist(),
+                'Tinv': self.Tinv.tolist(),
+                'B': self.__B.tolist() if self.nstar else None}
+
+    @classmethod
+    def from_state(cls, state):
+        """ Create a model from a state returned by get_state, without
+        recomputing the transformation matrix """
+        pm = cls(state['t0'], *state['z'], nstar=state['nstar'])
+        refs = state['refs']
+        pm.t_refs = [r[0] for r in refs]
+        pm.eq_refs = [EqCoords(r[1], r[2]) for r in refs]
+        pm.inst_refs = [Coords(r[3], r[4]) for r in refs]
+        pm.__ref_count = state['ref_count']
+        pm.__computed = state['computed']
+        pm.T = np.array(state['T'], dtype=float).reshape(3, 3)
+        pm.Tinv = np.array(state['Tinv'], dtype=float).reshape(3, 3)
+        if pm.nstar:
+            pm.__B = np.array(state['B'], dtype=float).reshape(3, 3)
+        pm.__update_tuples()
+        return pm
+
     def eq_to_inst(self, eq, t=0):
         """ Convert equatorial to instrumental coordinates"""
         if not self.__computed:
@@ -137,6 +267,127 @@ class PointingModel(object):
         eq = cosine_to_coords(v/np.linalg.norm(v))
         return self.__global_eq(eq, t or time.time())
 
+    def _cosine_to_app(self, m, x, y, z):
+        """ Multiply the equatorial direction cosine (x, y, z) by the 3x3
+        matrix m (a flat tuple) and return the apparent instrumental coords
+        of the result """
+        m00, m01, m02, m10, m11, m12, m20, m21, m22 = m
+        vx = m00*x + m01*y + m02*z
+        vy = m10*x + m11*y + m12*z
+        vz = m20*x + m21*y + m22*z
+
+        # real instrumental coords
+        a = atan2(vy, vx)
+        b = asin(max(-1., min(1., vz/sqrt(vx*vx + vy*vy + vz*vz))))
+
+        # apparent instrumental coords
+        z1, z2 = self.z1, self.z2
+        sa, ca, sb, cb = sin(a), cos(a), sin(b), cos(b)
+        return Coords(atan2(cb*sa - z2*ca + z1*sb*ca,
+                            cb*ca + z2*sa - z1*sb*sa),
+                      asin(sb) - self.z3)
+
+    def eq_to_inst_fast(self, eq, t=0):
+        """ Same as eq_to_inst, but computed with plain floats instead of
+        NumPy arrays. Much faster for a single target """
+        if not self.__computed:
+            raise ValueError("Instrument coordinates not aligned!")
+
+        ra = eq[0] - K*SEC2RAD*((t or time.time()) - self.t0)
+        cd = cos(eq[1])
+        return self._cosine_to_app(self.__Tt, cd*cos(ra), cd*sin(ra),
+                                   sin(eq[1]))
+
+    def sidereal_matrix(self, t=0):
+        """ Return T composed with the Earth rotation at time t, as a flat
+        tuple. Multiplying it by the direction cosine of a fixed object gives
+        its real instrumental direction cosine at time t. The last computed
+        matrix is cached """
+        t = t or time.time()
+        cached_t, cached_T, m = self.__sidereal
+        if t == cached_t and cached_T is self.__Tt:
+            return m
+
+        s, c = sin(K*SEC2RAD*(t - self.t0)), cos(K*SEC2RAD*(t - self.t0))
+        t00, t01, t02, t10, t11, t12, t20, t21, t22 = self.__Tt
+        m = (t00*c - t01*s, t00*s + t01*c, t02,
+             t10*c - t11*s, t10*s + t11*c, t12,
+             t20*c - t21*s, t20*s + t21*c, t22)
+        self.__sidereal = t, self.__Tt, m
+        return m
+
+    def track(self, eq):
+        """ Return a TrackedTarget for converting the given equatorial
+        coordinates at any time """
+        if not self.__computed:
+            raise ValueError("Instrument coordinates not aligned!")
+        return TrackedTarget(self, eq)
+
+    def inst_to_eq_fast(self, inst, t=0):
+        """ Same as inst_to_eq, but computed with plain floats instead of
+        NumPy arrays. Much faster for a single target """
+        a, b = inst[0], inst[1] + self.z3
+        z1, z2 = self.z1, self.z2
+        sa, ca, sb, cb = sin(a), cos(a), sin(b), cos(b)
+        x = cb*ca - z2*sa + z1*sb*sa
+        y = cb*sa + z2*ca - z1*sb*ca
+        z = sb
+
+        t00, t01, t02, t10, t11, t12, t20, t21, t22 = self.__Tinvt
+        vx = t00*x + t01*y + t02*z
+        vy = t10*x + t11*y + t12*z
+        vz = t20*x + t21*y + t22*z
+
+        ra = atan2(vy, vx) + K*SEC2RAD*((t or time.time()) - self.t0)
+        dec = asin(max(-1., min(1., vz/sqrt(vx*vx + vy*vy + vz*vz))))
+        return EqCoords(ra, dec)
+
+    def eq_to_inst_array(self, eq, t=0):
+        """ Convert an Nx2 array of equatorial coordinates to an Nx2 array of
+        instrumental coordinates. t can be a single timestamp or an array of
+        N timestamps """
+        if not self.__computed:
+            raise ValueError("Instrument coordinates not aligned!")
+
+        local = np.array(eq, dtype=float).reshape(-1, 2)
+        local[:, 0] -= self.__times(t, len(local))
+        real = cosines_to_coords(self.T.dot(eq_cosines(local)))
+        return self.real_to_app_array(real)
+
+    def inst_to_eq_array(self, inst, t=0):
+        """ Convert an Nx2 array of instrumental coordinates to an Nx2 array
+        of equatorial coordinates. t can be a single timestamp or an array of
+        N timestamps """
+        eq = cosines_to_coords(self.Tinv.dot(self.app_to_real_cosines(inst)))
+        eq[:, 0] += self.__times(t, len(eq))
+        return eq
+
+
+class TrackedTarget(object):
+    """ A fixed object (star) whose instrumental coordinates change with time.
+    The direction cosine is computed only once, so every conversion is a
+    single multiplication by the (cached) sidereal matrix of the model """
+
+    def __init__(self, pm, eq):
+        self.pm = pm
+        self.eq = EqCoords(eq[0], eq[1])
+        cd = cos(eq[1])
+        self.cosine = cd*cos(eq[0]), cd*sin(eq[0]), sin(eq[1])
+
+    def at(self, t=0):
+        """ Get the instrumental coordinates of the target at time t """
+        return self.pm._cosine_to_app(self.pm.sidereal_matrix(t), *self.cosine)
+
+    def trajectory(self, ts):
+        """ Get the instrumental coordinates of the target (Nx2 array) for an
+        array of N timestamps """
+        pm = self.pm
+        x, y, z = self.cosine
+        theta = K*SEC2RAD*(np.asarray(ts, dtype=float) - pm.t0)
+        s, c = np.sin(theta), np.cos(theta)
+        v = np.vstack((x*c + y*s, y*c - x*s, np.full_like(theta, z)))
+        return pm.real_to_app_array(cosines_to_coords(pm.T.dot(v)))
+
 
 if __name__ == '__main__':
     # usage example
@@ -166,3 +417,65 @@ if __name__ == '__main__':
     print "App1:", tgt
     print "App2:", pm.real_to_app_coords(real)
     print
+
+    # batch conversion of many targets
+    from timeit import timeit
+    n = 10000
+    eqs = np.random.RandomState(0).uniform([0, -pi/2], [2*pi, pi/2], (n, 2))
+    ts = np.linspace(78000, 79000, n)
+    insts = pm.eq_to_inst_array(eqs, ts)
+    print "Batch max error:", max(
+        abs(np.subtract(tuple(pm.eq_to_inst(eqs[i], ts[i])), insts[i])).max()
+        for i in range(0, n, 97))
+
+    t1 = timeit(lambda: pm.eq_to_inst(eqs[0], ts[0]), number=1000)/1000
+    t2 = timeit(lambda: pm.eq_to_inst_array(eqs, ts), number=10)/10/n
+    print "Single: %.2f us/point, batch: %.3f us/point" % (t1*1e6, t2*1e6)
+    print
+
+    # the scalar fast path must match the NumPy reference implementation
+    err1 = err2 = 0
+    for i in range(0, n, 97):
+        ref = pm.eq_to_inst(eqs[i], ts[i])
+        fast = pm.eq_to_inst_fast(eqs[i], ts[i])
+        err1 = max(err1, abs(ref[0] - fast[0]), abs(ref[1] - fast[1]))
+        ref = pm.inst_to_eq(eqs[i], ts[i])
+        fast = pm.inst_to_eq_fast(eqs[i], ts[i])
+        err2 = max(err2, abs(ref[0] - fast[0]), abs(ref[1] - fast[1]))
+    print "Fast path max error: %g (eq_to_inst), %g (inst_to_eq)" % (err1, err2)
+    assert err1 < 1e-12 and err2 < 1e-12
+
+    t3 = timeit(lambda: pm.eq_to_inst_fast(eqs[0], ts[0]), number=1000)/1000
+    print "Fast: %.2f us/point" % (t3*1e6)
+    print
+
+    # N-star alignment: use the stars converted above as references
+    pm2 = PointingModel(t=75600, z1=0.001, z2=0.002, z3=0.003, nstar=True)
+    for i in range(0, n, 1000):
+        pm2.set_ref(eqs[i], insts[i], t=ts[i])
+    print "N-star alignment with %d stars" % pm2.get_nrefs()
+    print "Instrumental:", pm2.eq_to_inst(tgt, t=78732)
+    print "Max T difference:", abs(pm2.T - pm.T).max()
+    print
+
+    # tracking a fixed target
+    target = pm.track(tgt)
+    traj = target.trajectory(ts)
+    print "Tracking max error: %g (at), %g (trajectory)" % (
+        max(abs(np.subtract(tuple(target.at(ts[i])), traj[i])).max()
+            for i in range(0, n, 97)),
+        abs(traj - pm.eq_to_inst_array([tgt[0], tgt[1]]*n, ts)).max())
+    t4 = timeit(lambda: target.at(ts[0]), number=1000)/1000
+    print "Tracked: %.2f us/point" % (t4*1e6)
+    print
+
+    # saving and restoring the model state
+    import json
+    for model in (pm, pm2):
+        state = json.loads(json.dumps(model.get_state()))
+        restored = PointingModel.from_state(state)
+        assert restored.eq_to_inst_fast(tgt, 78732) == \
+            model.eq_to_inst_fast(tgt, 78732)
+        assert restored.get_nrefs() == model.get_nrefs()
+    restored.set_ref(eqs[1], insts[1], t=ts[1])
+    print "Restored model state (%d refs)" % restored.get_nrefs()
@@ -0,0 +1,317 @@
+import time
+import logging
+import threading
+from protocol import STEPS
+from future import Future
+
+SPEED = 1600.           # Default motor speed (microsteps/s)
+SYNC_PERIOD = 1.        # Max. time (s) between position reads while moving
+IDLE_SYNC_PERIOD = 10.  # Max. time (s) between position reads while stopped
+TOLERANCE = 2           # Max. distance (microsteps) to the target on arrival
+MIN_CHECK_PERIOD = .05  # Min. time (s) between arrival checks
+
+# motion events
+MOVING = 'moving'       # a goto or move command has been sent
+ARRIVED = 'arrived'     # the motors have reached the commanded position
+STOPPED = 'stopped'     # the movement has been stopped or interrupted
+
+
+def _call_later(delay, func, *args):
+    tmr = threading.Timer(delay, func, args)
+    tmr.daemon = True
+    tmr.start()
+    return tmr
+
+
+def _distance(a, b):
+    """Distance (microsteps) between two motor positions"""
+    return max(min((x - y) % STEPS, (y - x) % STEPS) for x, y in zip(a, b))
+
+
+class Axis(object):
+    """A motor moving at constant speed"""
+
+    def __init__(self, speed=SPEED):
+        self.speed = speed
+        self.start_pos = 0.
+        self.start_t = 0.
+        self.delta = 0.     # signed number of steps of the current movement
+
+    def get_pos(self, t):
+        dist = min(abs(self.delta), self.speed*(t - self.start_t))
+        return (self.start_pos + (dist if self.delta >= 0 else -dist)) % STEPS
+
+    def is_moving(self, t):
+        return abs(self.delta) > self.speed*(t - self.start_t)
+
+    def end_time(self):
+        """Time at which the current movement ends"""
+        return self.start_t + abs(self.delta)/self.speed
+
+    def end_pos(self):
+        return (self.start_pos + self.delta) % STEPS
+
+    def move(self, delta, t):
+        self.start_pos = self.get_pos(t)
+        self.start_t = t
+        self.delta = delta
+
+    def goto(self, pos, t):
+        """Move to an absolute position following the shortest path"""
+        delta = (pos - self.get_pos(t)) % STEPS
+        self.move(delta if delta <= STEPS/2 else delta - STEPS, t)
+
+    def stop(self, t):
+        self.move(0, t)
+
+    def sync(self, pos, t):
+        """Correct the position with a measured one, keeping the end of the
+        current movement"""
+        end = self.start_pos + self.delta
+        rest = (end - pos) % STEPS
+        if min(rest, STEPS - rest) < 1:
+            rest = 0.
+        elif self.delta > 0:
+            rest = rest if rest <= STEPS/2 else 0.
+        elif self.delta < 0:
+            rest = rest - STEPS if rest > STEPS/2 else 0.
+        else:
+            rest = 0.
+        self.start_pos = float(pos)
+        self.start_t = t
+        self.delta = rest
+
+
+class PositionEstimator(object):
+    """Dead reckoning of the motor positions. The commanded movements are
+    followed with a constant speed model, which is corrected with the
+    positions read from the board (by get_pos, or pushed in binary mode).
+
+    A new position read is requested (without waiting for it) when the last
+    one is older than sync_period while moving or idle_period while stopped,
+    or when a movement has ended after it, so the arrival is confirmed.
+
+    goto and move return a Future completed when a position read confirms
+    that the motors are within tolerance of the commanded position (or
+    failed if they stop before). It is cancelled if another movement is
+    commanded. The listeners added with add_listener are called with the
+    event (MOVING, ARRIVED or STOPPED) and the motor positions.
+
+    The estimator can be used from several threads (commands, the thread
+    receiving the responses, timers): the axes are only changed and read
+    while holding a lock.
+
+    hw: Protocol or AsyncProtocol instance
+    speed: motor speed (microsteps/s) of both axes, or a (ha, el) tuple
+    call_later: function used to schedule the arrival checks, like
+    EventLoop.call_later (by default, a threading.Timer is started)
+    """
+
+    def __init__(self, hw, speed=SPEED, sync_period=SYNC_PERIOD,
+                 idle_period=IDLE_SYNC_PERIOD, tolerance=TOLERANCE,
+                 call_later=_call_later):
+        ha_speed, el_speed = speed if hasattr(speed, '__len__') \
+            else (speed, speed)
+        self.axes = Axis(ha_speed), Axis(el_speed)
+        self.sync_period = sync_period
+        self.idle_period = idle_period
+        self.tolerance = tolerance
+        self.__hw = hw
+        self.__call_later = call_later
+        self.__sync_t = None
+        self.__cmd_t = 0
+        self.__request = None
+        self.__lock = threading.RLock()
+        self.__listeners = []
+        self.__arrival = None
+        self.__target = None
+        self.__timer = None
+        self.__last_check = None
+        self.__closed = False
+
+    def add_listener(self, func):
+        """Call func(event, pos) on every motion event"""
+        self.__listeners.append(func)
+
+    def remove_listener(self, func):
+        self.__listeners.remove(func)
+
+    def __notify(self, event, pos):
+        for func in self.__listeners:
+            try:
+                func(event, pos)
+            except Exception:
+                logging.exception("Exception in motion listener")
+
+    def __start(self, command, args, t):
+        """Start following a new movement, calling command(axis, arg, t) for
+        every axis. Returns its arrival Future"""
+        arrival = Future()
+        with self.__lock:
+            for axis, arg in zip(self.axes, args):
+                command(axis, int(arg), t)
+            self.__cmd_t = t
+            old, self.__arrival = self.__arrival, arrival
+            self.__target = tuple(int(round(axis.end_pos())) % STEPS
+                                  for axis in self.axes)
+            self.__last_check = None
+            if self.__timer:
+                self.__timer.cancel()
+            self.__timer = self.__call_later(
+                max(self.end_time() - time.time(), MIN_CHECK_PERIOD),
+                self.__check)
+        if old:
+            old.cancel()
+        self.__notify(MOVING, self.__target)
+        return arrival
+
+    def goto(self, ha, el, t=0):
+        return self.__start(Axis.goto, (ha, el), t or time.time())
+
+    def move(self, ha, el, t=0):
+        return self.__start(Axis.move, (ha, el), t or time.time())
+
+    def home(self, t=0):
+        return self.goto(0, 0, t)
+
+    def follow(self, ha, el, t=0):
+        """Update the commanded position without waiting for the arrival
+        (for streamed waypoints or tracking corrections)"""
+        t = t or time.time()
+        with self.__lock:
+            for axis, pos in zip(self.axes, (ha, el)):
+                axis.goto(int(pos), t)
+            self.__cmd_t = t
+            arrival, self.__arrival = self.__arrival, None
+            if self.__timer:
+                self.__timer.cancel()
+                self.__timer = None
+        if arrival:
+            arrival.cancel()
+
+    def stop(self, t=0):
+        t = t or time.time()
+        with self.__lock:
+            for axis in self.axes:
+                axis.stop(t)
+            self.__cmd_t = t
+            arrival, self.__arrival = self.__arrival, None
+            if self.__timer:
+                self.__timer.cancel()
+                self.__timer = None
+        if arrival:
+            arrival.cancel()
+            self.__notify(STOPPED, self.predict(t))
+
+    def close(self):
+        """Stop the arrival checks and cancel the pending arrival. Must be
+        called before closing the port"""
+        with self.__lock:
+            self.__closed = True
+            arrival, self.__arrival = self.__arrival, None
+            if self.__timer:
+                self.__timer.cancel()
+                self.__timer = None
+        if arrival:
+            arrival.cancel()
+
+    def __check(self):
+        """Read the position to check if the motors have arrived"""
+        with self.__lock:
+            arrival = self.__arrival
+            self.__timer = None
+        if arrival and not self.__closed:
+            self.sync().add_done_callback(lambda f: self.__checked(f, arrival))
+
+    def __checked(self, future, arrival):
+        # called by the thread that receives the responses, which must not
+        # be blocked by the listeners
+        with self.__lock:
+            if arrival is not self.__arrival or self.__closed:
+                return
+            if future.exception() is not None:
+                self.__timer = self.__call_later(self.sync_period,
+                                                 self.__check)
+                return
+
+            pos = future.result()
+            if _distance(pos, self.__target) <= self.tolerance:
+                event = ARRIVED
+            elif pos == self.__last_check:
+                event = STOPPED
+            else:
+                # not there yet: check again when it should have arrived
+                self.__update()
+                self.__last_check = pos
+                self.__timer = self.__call_later(
+                    max(self.end_time() - time.time(), MIN_CHECK_PERIOD),
+                    self.__check)
+                return
+            self.__arrival = None
+        self.__call_later(0, self.__finish, arrival, event, pos)
+
+    def __finish(self, arrival, event, pos):
+        if event == ARRIVED:
+            arrival.set_result(pos)
+        else:
+            arrival.set_exception(
+                IOError("The motors stopped at %d, %d" % pos))
+        self.__notify(event, pos)
+
+    def __update(self):
+        """Use the last position received from the board, unless it was
+        measured before the last command"""
+        pos = self.__hw.last_pos
+        with self.__lock:
+            if pos and pos[2] >= self.__cmd_t and \
+                    (self.__sync_t is None or pos[2] > self.__sync_t):
+                for axis, p in zip(self.axes, pos[:2]):
+                    axis.sync(p, pos[2])
+                self.__sync_t = pos[2]
+
+    def is_synced(self):
+        self.__update()
+        return self.__sync_t is not None
+
+    def is_moving(self, t=0):
+        t = t or time.time()
+        with self.__lock:
+            return any(axis.is_moving(t) for axis in self.axes)
+
+    def end_time(self):
+        """Time at which the current movement ends"""
+        with self.__lock:
+            return max(axis.end_time() for axis in self.axes)
+
+    def needs_sync(self, t=0):
+        t = t or time.time()
+        with self.__lock:
+            self.__update()
+            if self.__sync_t is None:
+                return True
+            if self.__sync_t < self.end_time() <= t:
+                return True
+            age = t - self.__sync_t
+            return age > (self.sync_period if self.is_moving(t)
+                          else self.idle_period)
+
+    def sync(self):
+        """Request a position read. Returns its Future"""
+        if self.__request is None or self.__request.done():
+            self.__request = self.__hw.get_pos(wait=False)
+        return self.__request
+
+    def predict(self, t=0):
+        """Predicted motor positions (float microsteps) at time t"""
+        t = t or time.time()
+        with self.__lock:
+            self.__update()
+            return tuple(axis.get_pos(t) for axis in self.axes)
+
+    def get_pos(self, t=0):
+        """Predicted motor positions (microsteps) at time t, requesting a
+        position read if needed"""
+        t = t or time.time()
+        if self.needs_sync(t):
+            self.sync()
+        return tuple(int(round(p)) % STEPS for p in self.predict(t))
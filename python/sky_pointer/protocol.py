@@ -1,73 +1,501 @@
 #!/usr/bin/env python
 
+import os
+import re
 import time
+import errno
 import serial
 import struct
+import logging
 import threading
+from collections import deque
+from future import Future, gather
+import framing
+from framing import MOTION, POS, CALIB, INDEX
 
 STEPS = 3200    # Number of microsteps per revolution of the motors
 NRETRIES = 3    # Number of retries when sending a serial command
+TIMEOUT = 1.    # Max. time (s) waiting for the response to a command
+WAIT_TIMEOUT = 2*TIMEOUT    # Max. time (s) blocking on a response
+READY_TIMEOUT = 5.  # Max. time (s) waiting for the board after opening it
+BINARY_CAP = 'B'    # ID flag of the boards that support binary framing
 
+_EOL = re.compile('[\r\n]')
 
-class Protocol:
-    """Serial communication with SkyPointer board."""
 
-    def __init__(self, device='/dev/ttyUSB0', baud=115200):
-        self.__lock = threading.Lock()
-        self.__ser = serial.Serial(device, baud, timeout=1)
+def _parse_pos(ret):
+    ha, el = ret.split()[1:3]
+    return int(ha), int(el)
+
+
+def _parse_calib(ret):
+    v = int(ret.split()[1], 16)
+    cal = struct.unpack('!f', struct.pack('!I', v))[0]
+    return cal if abs(cal) < 1. else 0.0
+
+
+def _unpack_calib(ret):
+    cal = CALIB.unpack_from(ret, 1)[1]
+    return cal if abs(cal) < 1. else 0.0
+
+
+class _Request(object):
+    __slots__ = ('cmd', 'ret_ok', 'parse', 'future', 'deadline')
+
+    def __init__(self, cmd, ret_ok, parse, timeout):
+        self.cmd, self.ret_ok, self.parse = cmd, ret_ok, parse
+        self.future = Future()
+        self.deadline = time.time() + timeout
+
+
+class BaseProtocol(object):
+    """Encoding of the serial commands and matching of the responses. The
+    subclasses implement the I/O: _write(data) must write the data to the
+    port, and the received data must be passed to _feed(data).
+
+    Commands are written as soon as they are requested, without waiting for
+    the response of the previous ones. The responses are matched with the
+    pending requests (the board answers in order) to complete their futures.
+
+    In binary mode (see the framing module) the board sends its position
+    periodically while the motors are moving. The last known position is
+    stored in last_pos, and on_position(ha, el) is called, if set, every time
+    a new one is received. The timestamp of the positions read with get_pos
+    is the time the command was sent, so they are never newer than the
+    commands sent after them.
+    """
+
+    def __init__(self):
+        self._wlock = threading.Lock()
+        self.__plock = threading.Lock()
+        self.__pending = deque()
+        self.__binary = False
+        self.__parser = framing.FrameParser()
+        self.__buf = ''
+        self.hid = None
+        self.last_pos = None    # (ha, el, timestamp)
+        self.on_position = None
+
+    def is_binary(self):
+        return self.__binary
+
+    def _enable_binary(self, ret):
+        # called while parsing the response, so the data received after it
+        # is already parsed as binary frames
+        self.__binary = True
+        return ret
+
+    def _write(self, data):
+        raise NotImplementedError
+
+    def _request_queued(self, req):
+        pass
+
+    def _feed(self, data):
+        """Parse received data and dispatch the responses"""
+        buf = self.__buf + data
+        while buf and not self.__binary:
+            m = _EOL.search(buf)
+            if not m:
+                break
+            line, buf = buf[:m.start()], buf[m.end():]
+            if line:
+                self.__dispatch(line)
+
+        if buf and self.__binary:
+            for frame in self.__parser.feed(buf):
+                if frame[0] == framing.PUSH_POS:
+                    self._set_pos(POS.unpack_from(frame, 1))
+                else:
+                    self.__dispatch(frame)
+            buf = ''
+        self.__buf = buf
+
+    def _set_pos(self, pos, t=None):
+        self.last_pos = pos[0], pos[1], t or time.time()
+        if self.on_position:
+            self.on_position(*pos)
+        return pos
+
+    def __dispatch(self, line):
+        """Complete the request that corresponds to a response line"""
+        with self.__plock:
+            if not self.__pending:
+                logging.warning("Unexpected response: %s" % line)
+                return
+
+            # if a later request expects this response, the responses of the
+            # previous ones were lost. Otherwise, the line is the (wrong)
+            # response to the oldest request.
+            n = 0
+            for i, req in enumerate(self.__pending):
+                if line.startswith(req.ret_ok):
+                    n = i
+                    break
+            lost = [self.__pending.popleft() for i in range(n)]
+            req = self.__pending.popleft()
+
+        for r in lost:
+            r.future.set_exception(
+                IOError('Serial command "%s" got no response' % r.cmd))
+
+        if not line.startswith(req.ret_ok):
+            req.future.set_exception(
+                IOError('Serial command "%s" returned "%s"' % (req.cmd, line)))
+            return
+        try:
+            req.future.set_result(req.parse(line) if req.parse else line)
+        except (ValueError, IndexError, struct.error) as e:
+            req.future.set_exception(
+                IOError('Serial command "%s" returned "%s"' % (req.cmd, line)))
+
+    def _expire(self, now):
+        with self.__plock:
+            expired = [r for r in self.__pending if r.deadline < now]
+            for r in expired:
+                self.__pending.remove(r)
+        for r in expired:
+            r.future.set_exception(
+                IOError('Serial command "%s" timed out' % r.cmd))
+
+    def _fail_all(self, exception):
+        with self.__plock:
+            pending, self.__pending = self.__pending, deque()
+        for r in pending:
+            r.future.set_exception(exception)
+
+    def __submit(self, data, name, ret_ok, parse, timeout):
+        req = _Request(name, ret_ok, parse, timeout)
+        with self._wlock:
+            # the request must be queued in the same order as written
+            with self.__plock:
+                self.__pending.append(req)
+            try:
+                self._write(data)
+            except (serial.SerialException, IOError, OSError) as e:
+                with self.__plock:
+                    self.__pending.remove(req)
+                raise IOError(str(e))
+        self._request_queued(req)
+        return req.future
+
+    def submit(self, cmd, ret_ok='OK', parse=None, timeout=TIMEOUT):
+        """Send a serial command and return a Future of its response. If
+        parse is given, the result is parse(response)."""
+        return self.__submit(cmd + '\r', cmd, ret_ok, parse, timeout)
+
+    def submit_frame(self, opcode, payload='', parse=None, timeout=TIMEOUT):
+        """Send a binary command and return a Future of its response (a
+        string containing the opcode and the payload)"""
+        return self.__submit(framing.encode_frame(opcode, payload), opcode,
+                             opcode, parse, timeout)
+
+    def _request(self, cmd, ret_ok='OK', parse=None, frame=None):
+        """Send a command in the current mode. frame is a tuple (opcode,
+        payload, parse) used instead of the other arguments in binary mode."""
+        if self.__binary:
+            return self.submit_frame(*frame)
+        return self.submit(cmd, ret_ok, parse)
+
+    def _send_command(self, cmd, ret_ok='OK', parse=None, wait=True,
+                      frame=None):
+        raise NotImplementedError
+
+    def get_id(self, wait=True):
+        return self._send_command('I', 'SkyPointer', wait=wait,
+                                  frame=('I', '', lambda r: r[1:]))
+
+    def enable_laser(self, enable, wait=True):
+        return self._send_command('L %d' % int(enable), wait=wait,
+                                  frame=('L', INDEX.pack(int(enable)), None))
+
+    def goto(self, ha, el, wait=True):
+        payload = MOTION.pack(int(ha), int(el))
+        return self._send_command('G %d %d' % (ha, el), wait=wait,
+                                  frame=('G', payload, None))
+
+    def move(self, ha, el, wait=True):
+        payload = MOTION.pack(int(ha), int(el))
+        return self._send_command('M %d %d' % (ha, el), wait=wait,
+                                  frame=('M', payload, None))
+
+    def home(self, wait=True):
+        return self._send_command('H', wait=wait, frame=('H', '', None))
+
+    def stop(self, wait=True):
+        return self._send_command('S', wait=wait, frame=('S', '', None))
+
+    def quit(self, wait=True):
+        return self._send_command('Q', wait=wait, frame=('Q', '', None))
+
+    def get_pos(self, wait=True):
+        t = time.time()
+        unpack = lambda r: self._set_pos(POS.unpack_from(r, 1), t)
+        parse = lambda r: self._set_pos(_parse_pos(r), t)
+        return self._send_command('P', 'P ', parse, wait=wait,
+                                  frame=('P', '', unpack))
+
+    def get_calib(self, n, wait=True):
+        return self._send_command('R %d' % n, 'R ', _parse_calib, wait=wait,
+                                  frame=('R', INDEX.pack(n), _unpack_calib))
+
+    def set_calib(self, n, val, wait=True):
+        v = struct.unpack('!I', struct.pack('!f', val))[0]
+        return self._send_command('W %d %x' % (n, v), wait=wait,
+                                  frame=('W', CALIB.pack(n, val), None))
+
+
+class Protocol(BaseProtocol):
+    """Serial communication with SkyPointer board.
+
+    A reader thread receives the responses. The command methods block until
+    the response is received, unless wait=False is given, in which case they
+    return a Future.
+
+    If binary is True and the board supports it, the commands are sent as
+    binary frames, and the board sends its position every push_period
+    seconds while the motors are moving.
+    """
+
+    def __init__(self, device='/dev/ttyUSB0', baud=115200, binary=False,
+                 push_period=.1):
+        BaseProtocol.__init__(self)
+        self.__ser = serial.Serial(device, baud, timeout=.05)
         self.__ser.flushInput()
-        time.sleep(1.7)     # wait until Arduino bootloader exits
 
-    def __send_command(self, cmd, ret_len=3, ret_ok='OK'):
+        self.__running = True
+        self.__reader = threading.Thread(target=self.__read_loop)
+        self.__reader.daemon = True
+        self.__reader.start()
+
+        try:
+            self.__wait_ready()
+            if binary and BINARY_CAP in self.hid.split()[2:]:
+                self._send_command('B %d' % int(push_period*1000),
+                                   parse=self._enable_binary)
+        except IOError:
+            self.close(quit=False)
+            raise
+
+    def __wait_ready(self, timeout=READY_TIMEOUT):
+        """Poll the board with the ID command until it answers. If the port
+        has just been opened, the Arduino bootloader runs for a while and
+        ignores the commands."""
+        deadline = time.time() + timeout
+        delay = .02
+        while True:
+            try:
+                self.hid = self.submit('I', 'SkyPointer',
+                                       timeout=delay).result(WAIT_TIMEOUT)
+                return
+            except IOError:
+                if time.time() > deadline:
+                    raise IOError("The SkyPointer board is not responding")
+                delay = min(2*delay, .4)
+
+    def __read_loop(self):
+        while self.__running:
+            try:
+                data = self.__ser.read(self.__ser.inWaiting() or 1)
+            except (serial.SerialException, IOError, OSError) as e:
+                # nothing would expire the requests sent from now on
+                with self._wlock:
+                    self.__running = False
+                self._fail_all(IOError(str(e)))
+                break
+
+            if data:
+                self._feed(data)
+            self._expire(time.time())
+
+    def _write(self, data):
+        if not self.__running:
+            raise IOError("Serial port closed")
+        self.__ser.write(data)
+
+    def _send_command(self, cmd, ret_ok='OK', parse=None, wait=True,
+                      frame=None):
         """Send a serial command and check the response."""
-        with self.__lock:
-            for i in range(NRETRIES):
-                self.__ser.write(cmd + '\r')
-                ret = self.__ser.read(ret_len)
+        if not wait:
+            return self._request(cmd, ret_ok, parse, frame)
 
-                if ret.startswith(ret_ok):
-                    return ret
-                print "Command failed (%s). retrying" % cmd
-                self.__ser.flushInput()
+        for i in range(NRETRIES):
+            try:
+                return self._request(cmd, ret_ok, parse,
+                                     frame).result(WAIT_TIMEOUT)
+            except IOError as e:
+                logging.debug("Command failed (%s). retrying" % cmd)
+        raise e
 
-        raise IOError('Serial command "%s" returned "%s"' % (cmd, ret.strip()))
+    def get_calibs(self, n=3):
+        """Read the n first calibration values at once (all the requests are
+        sent without waiting for the responses)"""
+        for i in range(NRETRIES):
+            futures = [self.get_calib(j, wait=False) for j in range(n)]
+            try:
+                return [f.result(WAIT_TIMEOUT) for f in futures]
+            except IOError as e:
+                logging.debug("Command failed (R). retrying")
+        raise e
 
-    def get_id(self):
-        return self.__send_command('I', ret_len=15, ret_ok='SkyPointer')
+    def close(self, quit=True):
+        try:
+            if quit:
+                self.quit()
+        finally:
+            with self._wlock:
+                self.__running = False
+            self.__reader.join()
+            self._fail_all(IOError("Serial port closed"))
+            self.__ser.close()
 
-    def enable_laser(self, enable):
-        self.__send_command('L %d' % int(enable))
 
-    def goto(self, ha, el):
-        self.__send_command('G %d %d' % (ha, el))
+class AsyncProtocol(BaseProtocol):
+    """Serial communication with SkyPointer board, driven by an EventLoop.
 
-    def move(self, ha, el):
-        self.__send_command('M %d %d' % (ha, el))
+    The port is read when the loop reports it readable, and written without
+    blocking. All the command methods return a Future (the wait argument is
+    ignored), which fails after TIMEOUT seconds without response. Futures can
+    be cancelled; the response is then ignored. The futures are completed in
+    the loop thread.
 
-    def home(self):
-        self.__send_command('H')
+    connect() must be called (and its future waited for) before sending any
+    command.
+    """
 
-    def stop(self):
-        self.__send_command('S')
+    def __init__(self, loop, device='/dev/ttyUSB0', baud=115200):
+        BaseProtocol.__init__(self)
+        self.loop = loop
+        self.__ser = serial.Serial(device, baud, timeout=0)
+        self.__ser.flushInput()
+        self.__fd = self.__ser.fileno()
+        self.__wbuf = ''
+        self.__closed = False
+        loop.add_reader(self.__fd, self.__on_readable)
 
-    def quit(self):
-        self.__send_command('Q')
+    def connect(self, binary=False, push_period=.1, timeout=READY_TIMEOUT):
+        """Poll the board until it answers, and negotiate the binary mode.
+        Returns a Future of the board ID."""
+        result = Future()
+        deadline = self.loop.time() + timeout
 
-    def get_pos(self):
-        ret = self.__send_command('P', ret_len=12, ret_ok='P ')
-        ha, el = ret.strip().split()[1:3]
-        return int(ha), int(el)
+        def probe(delay):
+            f = self.submit('I', 'SkyPointer', timeout=delay)
+            f.add_done_callback(lambda f: answered(f, delay))
 
-    def get_calib(self, n):
-        ret = self.__send_command('R %d' % n, ret_len=11, ret_ok='R ')
-        v = int(ret.strip().split()[1], 16)
-        cal = struct.unpack('!f', struct.pack('!I', v))[0]
-        return cal if abs(cal) < 1. else 0.0
+        def answered(f, delay):
+            if result.done():
+                return
+            if f.exception() is not None:
+                if self.loop.time() > deadline:
+                    result.set_exception(
+                        IOError("The SkyPointer board is not responding"))
+                else:
+                    probe(min(2*delay, .4))
+                return
 
-    def set_calib(self, n, val):
-        v = struct.unpack('!I', struct.pack('!f', val))[0]
-        self.__send_command('W %d %x' % (n, v))
+            self.hid = f.result()
+            if binary and BINARY_CAP in self.hid.split()[2:]:
+                self._send_command(
+                    'B %d' % int(push_period*1000), parse=self._enable_binary
+                ).then(lambda r: self.hid).add_done_callback(result.copy_from)
+            else:
+                result.set_result(self.hid)
+
+        probe(.02)
+        return result
+
+    def __on_readable(self):
+        try:
+            data = os.read(self.__fd, 4096)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.__shutdown(IOError("Serial port closed"))
+            return
+        self._feed(data)
+
+    def _request_queued(self, req):
+        self.loop.call_at(req.deadline + .001, self.__on_timeout)
+
+    def __on_timeout(self):
+        self._expire(self.loop.time())
+
+    def _write(self, data):
+        if self.__closed:
+            raise IOError("Serial port closed")
+        self.__wbuf += data
+        self.__flush()
+
+    def __flush(self):
+        try:
+            n = os.write(self.__fd, self.__wbuf)
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                self.__shutdown(IOError(str(e)))
+                return
+            n = 0
+        self.__wbuf = self.__wbuf[n:]
+        if self.__wbuf:
+            self.loop.add_writer(self.__fd, self.__flush)
+        else:
+            self.loop.remove_writer(self.__fd)
 
-    def close(self):
-        self.quit()
+    def _send_command(self, cmd, ret_ok='OK', parse=None, wait=True,
+                      frame=None):
+        """Send a serial command. Returns a Future of the response. The
+        command is retried if it fails, unless the future is cancelled."""
+        result = Future()
+
+        def attempt(n):
+            try:
+                f = self._request(cmd, ret_ok, parse, frame)
+            except IOError as e:
+                result.set_exception(e)
+                return
+            f.add_done_callback(lambda f: done(f, n))
+
+        def done(f, n):
+            if result.done():
+                return
+            if f.exception() is None:
+                result.set_result(f.result())
+            elif n + 1 < NRETRIES:
+                logging.debug("Command failed (%s). retrying" % cmd)
+                attempt(n + 1)
+            else:
+                result.set_exception(f.exception())
+
+        attempt(0)
+        return result
+
+    def get_calibs(self, n=3):
+        """Read the n first calibration values at once. Returns a Future of
+        the list of values."""
+        return gather([self.get_calib(j) for j in range(n)])
+
+    def __shutdown(self, exception):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.loop.remove_reader(self.__fd)
+        self.loop.remove_writer(self.__fd)
+        self._fail_all(exception)
         self.__ser.close()
+
+    def close(self, quit=True):
+        """Close the port. If quit is True, the Q command is sent before and
+        the returned Future is completed when the port is closed."""
+        closed = Future()
+
+        def shutdown(f=None):
+            self.__shutdown(IOError("Serial port closed"))
+            closed.set_result(None)
+
+        if quit and not self.__closed:
+            self.quit().add_done_callback(shutdown)
+        else:
+            shutdown()
+        return closed
@@ -1,18 +1,31 @@
 #!/usr/bin/env python
 
 import time
+import errno
 import struct
 import logging
 import threading
-from math import pi
+from math import pi, cos
+from collections import deque
 import socket
-import select
 import coords
+from eventloop import EventLoop
+
+GOTO_SIZE = 20      # Size of the client->server "goto" packet
+MAX_PACKET = 1024   # Max. accepted packet size
+QUEUE_SIZE = 8      # Max. number of packets waiting to be sent to a client
+POS_RATE = 2.       # Default number of position broadcasts per second
+POS_THRESHOLD = 1e-4    # Default min. position change (rad) to send a packet
+KEEPALIVE = 5.      # Max. time (s) without sending the position
+LISTEN_BACKLOG = 32
+
+GOTO_STRUCT = struct.Struct('<HHQIi')
+POS_STRUCT = struct.Struct('<HHQIii')
 
 
 def decode_goto_packet(data):
     """Decode Stellarium client->server "goto" packet"""
-    fields = struct.unpack('<HHQIi', data)
+    fields = GOTO_STRUCT.unpack(data)
     return coords.EqCoords(fields[3]*pi/0x80000000, fields[4]*pi/0x80000000)
 
 
@@ -20,12 +33,12 @@ def encode_goto_packet(coords):
     """Encode Stellarium client->server "goto" packet"""
     ra = long((coords[0] % (2*pi))/pi*0x80000000)
     dec = long(coords[1]/pi*0x80000000)
-    return struct.pack('<HHQIi', 24, 0, time.time()*1e6, ra, dec)
+    return GOTO_STRUCT.pack(GOTO_SIZE, 0, time.time()*1e6, ra, dec)
 
 
 def decode_pos_packet(data):
     """Decode Stellarium server->client "current postion" packet"""
-    fields = struct.unpack('<HHQIii', data)
+    fields = POS_STRUCT.unpack(data)
     return coords.EqCoords(fields[3]*pi/0x80000000, fields[4]*pi/0x80000000)
 
 
@@ -33,80 +46,251 @@ def encode_pos_packet(coords):
     """Encode Stellarium server->client "current postion" packet"""
     ra = long((coords[0] % (2*pi))/pi*0x80000000)
     dec = long(coords[1]/pi*0x80000000)
-    return struct.pack('<HHQIii', 24, 0, time.time()*1e6, ra, dec, 0)
+    return POS_STRUCT.pack(POS_STRUCT.size, 0, time.time()*1e6, ra, dec, 0)
+
+
+class PositionBroadcaster(object):
+    """Sends the position to all the clients of a server at a fixed rate.
+    Every tick the packet is encoded once into a reusable buffer and shared
+    by all the clients. It is not sent if the position has moved less than
+    threshold (rad) since the last one, unless it was sent more than
+    KEEPALIVE seconds ago."""
+
+    def __init__(self, server, rate=POS_RATE, threshold=POS_THRESHOLD):
+        self.server = server
+        self.loop = server.loop
+        self.period = 1./rate
+        self.threshold = threshold
+        self.buf = bytearray(POS_STRUCT.size)
+        self.__sent = None      # last position sent
+        self.__sent_t = 0
+        self.__next = self.loop.time() + self.period
+        self.__timer = self.loop.call_at(self.__next, self.__tick)
+
+    def __changed(self, pos):
+        if self.__sent is None:
+            return True
+        dra = (pos[0] - self.__sent[0] + pi) % (2*pi) - pi
+        return max(abs(dra*cos(pos[1])), abs(pos[1] - self.__sent[1])) >= \
+            self.threshold
+
+    def __tick(self):
+        # scheduled from the previous deadline, so the rate does not drift
+        now = self.loop.time()
+        self.__next = max(self.__next + self.period, now)
+        self.__timer = self.loop.call_at(self.__next, self.__tick)
+
+        pos = self.server.pos
+        if not self.server.clients or not (
+                self.__changed(pos) or now - self.__sent_t >= KEEPALIVE):
+            return
+        ra = long((pos[0] % (2*pi))/pi*0x80000000)
+        dec = long(pos[1]/pi*0x80000000)
+        POS_STRUCT.pack_into(self.buf, 0, POS_STRUCT.size, 0, now*1e6,
+                             ra, dec, 0)
+        self.server.broadcast(str(self.buf))
+        self.__sent, self.__sent_t = pos, now
+
+    def cancel(self):
+        self.__timer.cancel()
+
+
+class StellariumFramer(object):
+    """Incremental decoder of the packets received from a client. Every
+    packet starts with its length and type (two 16-bit integers), so it can
+    be split or joined with others by TCP"""
+
+    def __init__(self):
+        self.buf = ''
+
+    def feed(self, data):
+        """Append received data and return the list of complete packets"""
+        buf = self.buf + data
+        packets = []
+        start = 0
+        while len(buf) - start >= 4:
+            size = struct.unpack_from('<H', buf, start)[0]
+            if size < 4 or size > MAX_PACKET:
+                # corrupted stream: discard the received data
+                logging.error("Invalid packet length: %d" % size)
+                start = len(buf)
+                break
+            if len(buf) - start < size:
+                break
+            packets.append(buf[start:start + size])
+            start += size
+        self.buf = buf[start:]
+        return packets
+
+    def gotos(self, data):
+        """Return the targets of the goto packets in the received data"""
+        targets = []
+        for packet in self.feed(data):
+            ptype = struct.unpack_from('<H', packet, 2)[0]
+            if ptype != 0 or len(packet) != GOTO_SIZE:
+                logging.debug("Ignoring packet of type %d" % ptype)
+                continue
+            targets.append(decode_goto_packet(packet))
+        return targets
+
+
+class StellariumClient(object):
+    """A connection with a Stellarium client. The packets sent to the client
+    are queued and written when the socket is writable. If the client does
+    not read them, the oldest ones are dropped (they are all position
+    packets, so only the newest matter)."""
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.loop = server.loop
+        self.sock = sock
+        self.addr = addr
+        self.framer = StellariumFramer()
+        self.queue = deque(maxlen=QUEUE_SIZE)
+        self.out = ''       # rest of the packet being written
+        self.dropped = 0
+        sock.setblocking(False)
+        self.loop.add_reader(sock.fileno(), self.on_readable)
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(1024)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.close()
+            return
+        try:
+            targets = self.framer.gotos(data)
+        except struct.error as e:
+            logging.error(e)
+            return
+        if targets:
+            self.server.new_target(targets[-1])
+
+    def send(self, packet):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(packet)
+        if not self.out:
+            self.loop.add_writer(self.sock.fileno(), self.on_writable)
+
+    def on_writable(self):
+        while self.out or self.queue:
+            if not self.out:
+                self.out = self.queue.popleft()
+            try:
+                n = self.sock.send(self.out)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                self.close()
+                return
+            self.out = self.out[n:]
+        self.loop.remove_writer(self.sock.fileno())
+
+    def close(self):
+        fd = self.sock.fileno()
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        self.sock.close()
+        self.server.clients.remove(self)
+        logging.debug("Client disconnected [%s, %d]" % self.addr)
 
 
 class StellariumServer(object):
-    """A TCP server that implements the Stellarium client-server protocol
+    """A TCP server that implements the Stellarium client-server protocol,
+    driven by an EventLoop (a new one, unless loop is given). The current
+    position (see set_pos) is sent to all the clients rate times per second,
+    when it changes more than threshold (rad).
     goto: callback function that will be called every time a new 'goto' command
-    is received
+    is received. When several commands are received at once, only the last
+    one is passed.
     """
-    def __init__(self, host='0.0.0.0', port=10000, goto=None):
+    def __init__(self, host='0.0.0.0', port=10000, goto=None, loop=None,
+                 rate=POS_RATE, threshold=POS_THRESHOLD):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         sock.bind((host, port))
-        sock.listen(5)
+        sock.listen(LISTEN_BACKLOG)
+        sock.setblocking(False)
         self.listening_socket = sock
         self.goto = goto
         self.pos = (0, 0)
+        self.loop = loop or EventLoop()
+        self.clients = []
+        self.__target = None
+        self.loop.add_reader(sock.fileno(), self.__accept)
+        self.broadcaster = PositionBroadcaster(self, rate, threshold)
 
-        # List of socket objects that are currently open
-        self.sockets = [sock]
-
-    def serve_forever(self):
+    def __accept(self):
         while True:
-            # Waits for I/O being available for reading from any socket object.
-            rlist, _, _ = select.select(self.sockets, [], [], 0.5)
-            for conn in rlist:
-                if conn is self.listening_socket:
-                    new_socket, addr = self.listening_socket.accept()
-                    self.sockets.append(new_socket)
-                    logging.debug("New client [%s, %d]" % addr)
-                else:
-                    try:
-                        data = conn.recv(1024)
-                    except socket.error:
-                        continue
-                    if data:
-                        try:
-                            tgt = coords.EqCoords(*decode_goto_packet(data))
-                        except struct.error as e:
-                            logging.error(e)
-                            continue
-
-                        logging.info("New target: %s" % tgt)
-                        if callable(self.goto):
-                            try:
-                                self.goto(tgt)
-                            except ValueError as e:
-                                logging.debug(e)
-                    else:
-                        self.sockets.remove(conn)
-                        logging.debug("Client disconnected")
-
-            """Send the current position to all connected clients"""
-            for s in self.sockets[1:]:
-                try:
-                    s.send(encode_pos_packet(self.pos))
-                except IOError as e:
+            try:
+                sock, addr = self.listening_socket.accept()
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
                     logging.error(e)
+                return
+            client = StellariumClient(self, sock, addr)
+            self.clients.append(client)
+            # the broadcaster only sends the position when it changes
+            client.send(encode_pos_packet(self.pos))
+            logging.debug("New client [%s, %d]" % addr)
+
+    def new_target(self, tgt):
+        # the target is passed after reading all the ready sockets, so only
+        # the newest one of a burst is sent to the pointer
+        if self.__target is None:
+            self.loop.call_soon(self.__forward)
+        self.__target = tgt
+
+    def __forward(self):
+        tgt, self.__target = self.__target, None
+        logging.info("New target: %s" % tgt)
+        if callable(self.goto):
+            try:
+                self.goto(tgt)
+            except ValueError as e:
+                logging.debug(e)
+
+    def broadcast(self, packet):
+        """Send a packet to all connected clients"""
+        for client in self.clients:
+            client.send(packet)
+
+    def serve_forever(self):
+        self.loop.run_forever()
 
     def set_pos(self, pos):
         """Set the current position"""
         self.pos = pos
 
+    def close(self):
+        """Close all the connections. Must be called from the loop thread"""
+        self.broadcaster.cancel()
+        for client in self.clients[:]:
+            client.close()
+        self.loop.remove_reader(self.listening_socket.fileno())
+        self.listening_socket.close()
+
 
 class StellariumServerThread(threading.Thread):
-    def __init__(self, host='0.0.0.0', port=10000, goto=None):
+    def __init__(self, host='0.0.0.0', port=10000, goto=None,
+                 rate=POS_RATE, threshold=POS_THRESHOLD):
         threading.Thread.__init__(self)
         self.daemon = True
-        self.server = StellariumServer(host, port, goto)
+        self.server = StellariumServer(host, port, goto, rate=rate,
+                                       threshold=threshold)
 
     def run(self):
         self.server.serve_forever()
+        self.server.close()
+        self.server.loop.close()
 
     def stop(self):
-        pass
+        self.server.loop.stop()
 
     def set_pos(self, pos):
         self.server.set_pos(pos)
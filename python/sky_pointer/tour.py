@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import time
+import logging
+import threading
+import numpy as np
+from protocol import STEPS
+from position import SPEED
+from future import CancelledError
+
+DWELL = 5.          # Default time (s) pointing to every target
+GOTO_TIMEOUT = 30.  # Max. time (s) waiting for the arrival to a target
+
+
+def _speeds(speed):
+    return np.array(speed if hasattr(speed, '__len__') else (speed, speed),
+                    dtype=float)
+
+
+def slew_time(a, b, speed=SPEED):
+    """Time (s) needed to move the motors from a to b (positions in
+    microsteps). Both axes move at the same time following the shortest
+    path, like the firmware does"""
+    d = np.abs(np.asarray(b, dtype=float) - a) % STEPS
+    return np.max(np.minimum(d, STEPS - d)/_speeds(speed))
+
+
+def slew_times(steps, speed=SPEED):
+    """Matrix of slew times between every pair of Nx2 motor positions"""
+    steps = np.asarray(steps, dtype=float)
+    d = np.abs(steps[:, None, :] - steps[None, :, :]) % STEPS
+    return np.max(np.minimum(d, STEPS - d)/_speeds(speed), axis=2)
+
+
+def _nearest_neighbour(cost, start):
+    n = len(cost)
+    order = [start]
+    left = np.ones(n, dtype=bool)
+    left[start] = False
+    for i in range(n - 1):
+        c = np.where(left, cost[order[-1]], np.inf)
+        order.append(int(np.argmin(c)))
+        left[order[-1]] = False
+    return order
+
+
+def _two_opt(cost, order):
+    """Improve an open path with a fixed start by reversing segments while
+    the total cost decreases"""
+    order = np.array(order)
+    n = len(order)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            # reverse order[i:j+1] for every j > i at once
+            a, b = order[i - 1], order[i]
+            c = order[i + 1:]
+            d = np.append(order[i + 2:], -1)
+            old = cost[a, b] + np.where(d >= 0, cost[c, d], 0)
+            new = cost[a, c] + np.where(d >= 0, cost[b, d], 0)
+            gain = old - new
+            j = np.argmax(gain)
+            if gain[j] > 1e-9:
+                order[i:i + j + 2] = order[i:i + j + 2][::-1].copy()
+                improved = True
+    return list(order)
+
+
+def plan_tour(steps, start=None, speed=SPEED):
+    """Order the targets (Nx2 motor positions) to minimize the total slew
+    time, starting from the position start (by default, from the first
+    target). Returns the list of indices of the targets"""
+    steps = np.asarray(steps, dtype=float).reshape(-1, 2)
+    if len(steps) < 2:
+        return range(len(steps))
+    if start is not None:
+        steps = np.vstack([start, steps])
+
+    cost = slew_times(steps, speed)
+    order = _two_opt(cost, _nearest_neighbour(cost, 0))
+    return [i - 1 for i in order[1:]] if start is not None else order
+
+
+def tour_time(steps, order, start=None, speed=SPEED):
+    """Total slew time (s) of a tour"""
+    path = [steps[i] for i in order]
+    if start is not None:
+        path.insert(0, start)
+    return sum(slew_time(a, b, speed) for a, b in zip(path[:-1], path[1:]))
+
+
+class Tour(object):
+    """A sequence of targets visited by a Pointer, ordered to minimize the
+    total slew time.
+
+    targets: list of EqCoords
+    dwell: time (s) pointing to every target (a value or a list)
+    speed: motor speed (microsteps/s) of both axes, or a (ha, el) tuple
+    """
+
+    def __init__(self, pointer, targets, dwell=DWELL, speed=SPEED):
+        self.ptr = pointer
+        self.targets = list(targets)
+        self.dwell = dwell if hasattr(dwell, '__len__') \
+            else [dwell]*len(self.targets)
+        if len(self.dwell) != len(self.targets):
+            raise ValueError("Wrong number of dwell times")
+        self.speed = speed
+        self.order = range(len(self.targets))
+        self.__stop = threading.Event()
+
+    def plan(self):
+        """Order the targets from the current position. Returns the
+        estimated duration of the tour"""
+        start = self.ptr.position.predict()
+        steps = [self.ptr.get_steps(eq) for eq in self.targets]
+        self.order = plan_tour(steps, start, self.speed)
+        return tour_time(steps, self.order, start, self.speed) + \
+            sum(self.dwell)
+
+    def run(self, callback=None):
+        """Visit the targets. callback(index, target) is called on the
+        arrival to every target"""
+        self.__stop.clear()
+        for i in self.order:
+            if self.__stop.is_set():
+                break
+            tgt = self.targets[i]
+            try:
+                self.ptr.goto(tgt).result(GOTO_TIMEOUT)
+            except CancelledError:
+                break
+            except (IOError, ValueError) as e:
+                logging.error("Target %s: %s" % (tgt, e))
+                continue
+            if callback:
+                callback(i, tgt)
+            self.__stop.wait(self.dwell[i])
+
+    def stop(self):
+        self.__stop.set()
+
+
+if __name__ == '__main__':
+    from coords import EqCoords
+    from pointing_model import PointingModel
+    from pointer import rad2steps
+    from gui.bright_stars import bright_stars
+
+    pm = PointingModel()
+    pm.set_ref(EqCoords(0, 0), EqCoords(0, 0), 0)
+    pm.set_ref(EqCoords(1, 1), EqCoords(1, 1), 0)
+
+    stars = [EqCoords(s[2], s[3]) for s in bright_stars]
+    steps = [rad2steps(*pm.eq_to_inst_fast(s)) for s in stars]
+    start = (0, 0)
+
+    t = time.time()
+    order = plan_tour(steps, start)
+    t = time.time() - t
+    print "%d targets (planned in %.3f s)" % (len(stars), t)
+    print "Catalog order:   %.1f s" % tour_time(steps, range(len(stars)),
+                                                start)
+    print "Optimized order: %.1f s" % tour_time(steps, order, start)
+    assert sorted(order) == range(len(stars))